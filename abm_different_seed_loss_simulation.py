@@ -1,99 +1,144 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from solve_for_flow import solve_for_flow
-from cell_migration import cell_migration, caculate_branch_probability
-from realign_polarity import realign_polarity
-from plot_network import plot_network
-from make_segments import make_segments
-from abm_ec_simulation_v2 import initialize_segments, compute_conductance
-from random_seed_list import *
-import copy
-import random
-import json
-from joblib import Parallel, delayed
+from solve_for_flow import solve_for_flow, IncrementalFlowSolver, flow_system
+from cell_migration import cell_migration, migration_table, JunctionRegistry
+from realign_polarity import realign_polarity, segment_axis
+from abm_ec_simulation_v2 import initialize_segments, ConductanceModel
+from random_streams import RandomStreams
+from profiling import stage_context
 
 def store_output(seed, Ncell, D, P1, t):
+    # P1 is one value or one per junction; the first junction is stored as
+    # "P1" and, with several junctions, all of them as "P1 Junctions"
+    P1 = np.atleast_1d(P1)
     # Store results in a dictionary
     result = {
         "Random Seed": int(seed),  # 转换为 Python 的 int 类型
         "Time Step": int(t),       # 转换为 Python 的 int 类型
         "Ncell": [int(n) for n in Ncell],  # 转换为 Python 的 int 类型列表
         "D": [float(d) for d in D],       # 转换为 Python 的 float 类型列表
-        "P1": float(P1)                   # 转换为 Python 的 float 类型
+        "P1": float(P1[0]) if len(P1) else float('nan')  # 转换为 Python 的 float 类型
     }
+    if len(P1) > 1:
+        result["P1 Junctions"] = [float(p) for p in P1]
     return result
 
-### Run a single simulation with the given random seed and parameters
-def run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha, w1, w2, w3, w4, L):
+def stop_record(reason, step):
+    # Early-termination fields of the last record of a monitored run
+    return {"Stop Reason": str(reason) or None, "Stop Step": int(step) if step >= 0 else None}
 
-    np.random.seed(seed)  # Set the random seed
-    random.seed(seed)
+### Run a single simulation with the given random seed and parameters
+def run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha, w1, w2, w3, w4, L,
+                   incremental_flow=False, monitor=None, network=None, rng=None, profiler=None,
+                   observer=None):
+    # With a ConvergenceMonitor the run stops once it has resolved; the
+    # remaining steps repeat the final state and the last record gets the
+    # "Stop Reason" and "Stop Step"
+    # network (a network.Network, the default 40-segment network if None)
+    # must have Nseg segments; L gives their lengths for the conductance.
+    # branch_rule and branch_alpha may also give one value per bifurcation
+    # rng is the RandomStreams the run draws from, spawned from seed if None
+    # profiler (a profiling.StageProfiler) times every stage of every step
+    # With an observer (see observers.py) the state after every step is
+    # passed to it instead of being kept (a stopped run is not padded) and
+    # None is returned
+
+    # Compile the network topology once
+    system = flow_system(network)
+    table = migration_table(network)
+    axis = segment_axis(network)
+    junctions = JunctionRegistry(table[3], branch_rule, branch_alpha)
+    conductance = ConductanceModel(Nseg, cell_size, mu, L)
+
+    # Reuse the flow factorization between steps if requested
+    if incremental_flow:
+        flow_solve = IncrementalFlowSolver(system).solve
+    else:
+        flow_solve = lambda G, Pin, Pout, H: solve_for_flow(G, Pin, Pout, H, system)
+
+    if rng is None:
+        rng = RandomStreams(seed)  # Independent streams from the random seed
+    stage = stage_context(profiler)
+    if profiler is not None:
+        profiler.start_run(seed)
     # Initialize cell and vessel segment properties
     Ncell = np.ones(Nseg) * num_cell
-    seg_cells = initialize_segments(Nseg, num_cell)
+    cells = initialize_segments(Nseg, num_cell, rng.init)
 
     # Compute initial conductance and shear stress
-    D, G, H = compute_conductance(Nseg, Ncell, cell_size, mu, L)
+    D, G, H = conductance(Ncell)
 
     # Solve for initial flow
-    P, Q, tau = solve_for_flow(G, Pin, Pout, H)
+    P, Q, tau = flow_solve(G, Pin, Pout, H)
 
-    P1 = caculate_branch_probability(seg_cells, tau, branch_alpha)
+    P1 = junctions.branch_probability(cells.counts, tau)
 
     # Store initial state
     time_series_results = []  # Store results for all time steps
-    initial_result = store_output(seed, Ncell, D, P1, 0)
-    time_series_results.append(initial_result)
+    if observer is None:
+        initial_result = store_output(seed, cells.counts, D, P1, 0)
+        time_series_results.append(initial_result)
+    else:
+        observer.update(seed, 0, cells.counts, D, P1)
+    t_last = 0
+    if monitor is not None:
+        monitor.start(network=network)
+        stopped = monitor.update(0, cells.counts)[0]
 
     # Time-stepping loop
     for t in range(Nt):
-        migrate = np.zeros(Nseg)
-        new_seg_cells = copy.deepcopy(seg_cells)
+        if monitor is not None and stopped:
+            break
 
-        for seg in range(Nseg):
-            seg_cells, new_seg_cells = realign_polarity(seg, Q, seg_cells, new_seg_cells, w1, w2, w3, w4)
-            seg_cells, new_seg_cells = cell_migration(seg, seg_cells, new_seg_cells, migrate, Q, branch_rule, branch_alpha, tau)
+        migrate = np.zeros(Nseg)
 
-        seg_cells = copy.deepcopy(new_seg_cells)
+        with stage("realign"):
+            cells = realign_polarity(Q, cells, w1, w2, w3, w4, axis=axis, rng=rng.polarity)
+        with stage("migration"):
+            cells = cell_migration(cells, migrate, Q, branch_rule, branch_alpha, tau, table, junctions,
+                                   rng.migration, rng.branch)
 
-        # Update Ncell
-        for seg in range(Nseg):
-            Ncell[seg] = seg_cells[seg]['num']
+        with stage("swap"):
+            cells.swap()  # Next state becomes current
 
         # Update conductance and shear stress
-        D, G, H = compute_conductance(Nseg, Ncell, cell_size, mu, L)
+        with stage("conductance"):
+            D, G, H = conductance(cells.counts)
 
         # Solve for updated flow
-        P, Q, tau = solve_for_flow(G, Pin, Pout, H)
+        with stage("flow"):
+            P, Q, tau = flow_solve(G, Pin, Pout, H)
 
-        P1 = caculate_branch_probability(seg_cells, tau, branch_alpha)
-    
         # Store the output of the simulation
-        result = store_output(seed, Ncell, D, P1, t+1)
-        time_series_results.append(result)
+        with stage("output"):
+            P1 = junctions.branch_probability(cells.counts, tau)
+            if observer is None:
+                result = store_output(seed, cells.counts, D, P1, t+1)
+                time_series_results.append(result)
+            else:
+                observer.update(seed, t+1, cells.counts, D, P1)
+        t_last = t+1
+        if profiler is not None:
+            profiler.end_step(t+1, len(cells), migrate.sum())
+
+        if monitor is not None:
+            stopped = monitor.update(t+1, cells.counts)[0]
+
+    if profiler is not None:
+        profiler.end_run(t_last)
+    if observer is not None:
+        observer.finish(seed, None if monitor is None else stop_record(monitor.reason[0], monitor.step[0]))
+        return None
+
+    # Pad a stopped run with its final state
+    for t in range(len(time_series_results), Nt+1):
+        time_series_results.append(store_output(seed, cells.counts, D, P1, t))
+    if monitor is not None:
+        time_series_results[-1].update(stop_record(monitor.reason[0], monitor.step[0]))
 
     return time_series_results
 
-# # Initialize empty list to store all results
-# all_results = []
-
-# # random_seeds = np.random.randint(0, 1000000000, size=10)  # Generate random seeds for multiple simulations
-# print(random_seeds)
-# # Run multiple simulations with different random seeds
-# for seed in random_seeds:  # Use the generated random seeds
-#     print(f"Running simulation with random seed {seed}")
-#     seed_results = run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, 
-#                                 branch_rule, branch_alpha, w1, w2, w3, w4, L)
-#     all_results.extend(seed_results)
-
-
-# # with open("time_series_results.json", "w") as f:
-# #     json.dump(all_results, f, indent=4)
-# output_name = "time_series_results_a_" + str(branch_alpha) + ".json"
-# with open(output_name, "w") as f:
-#     json.dump(all_results, f, indent=1, separators=(',', ':'))
-
 if __name__ == "__main__":
+    from random_seed_list import random_seeds
     
     # Input parameters
     Nt = 60  # Number of time steps
@@ -123,56 +168,32 @@ if __name__ == "__main__":
     H = np.zeros(Nseg)  # Shear stress calculation factor
 
 
-    # Initialize empty list to store all results
-    all_results = []
-
-    # random_seeds = np.random.randint(0, 1000000000, size=10)  # Generate random seeds for multiple simulations
-    # Run multiple simulations with different random seeds
-    for seed in random_seeds[0:10]:  # Use the generated random seeds
-        print(f"Running simulation with random seed {seed}")
-        seed_results = run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, 
-                                    branch_rule, branch_alpha, w1, w2, w3, w4, L)
-        all_results.extend(seed_results)
-        break
-
-
-    # with open("time_series_results.json", "w") as f:
-    #     json.dump(all_results, f, indent=4)
-    output_name = "time_series_results_BR1.json"
-    with open(output_name, "w") as f:
-        json.dump(all_results, f, indent=1, separators=(',', ':'))
+    # Stream every record to a JSON-lines file as the runs go, instead of
+    # collecting all results before one dump; e.g. every=10 keeps every
+    # 10th step and segments=BRANCH_DAUGHTERS only the daughter branches
+    from observers import JsonlSink
+    output_name = "time_series_results_BR1.jsonl"
+    with JsonlSink(output_name) as sink:
+        # random_seeds = np.random.randint(0, 1000000000, size=10)  # Generate random seeds for multiple simulations
+        # Run multiple simulations with different random seeds
+        for seed in random_seeds[0:10]:  # Use the generated random seeds
+            print(f"Running simulation with random seed {seed}")
+            run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size,
+                           branch_rule, branch_alpha, w1, w2, w3, w4, L, observer=sink)
+            break
 
 
     # # 生成 alpha 值序列，从 0 到 1，步长为 0.05
     # alpha_values = np.arange(0, 1.05, 0.05)
 
-    # import os
-    
-    # # 创建保存结果的目录
-    # output_dir = "Data"
-    
-    # # 遍历所有 alpha 值
-    # for alpha in alpha_values:
-    #     print(f"Running simulations for alpha = {alpha:.2f}")
-    #     # Initialize empty list to store all results
-    #     all_results = []
-    
-    #     # for seed in random_seeds:  # Use the generated random seeds
-    #     #     # print(f"Running simulation with random seed {seed}")
-    #     #     seed_results = run_simulation(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, 
-    #     #                             branch_rule, alpha, w1, w2, w3, w4, L)
-    #     #     all_results.extend(seed_results)
-        
-    #     all_results = Parallel(n_jobs=-1)(delayed(run_simulation)
-    #                   (seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, alpha, w1, w2, w3, w4, L) 
-    #                   for seed in random_seeds)
-    #     # 扁平化结果
-    #     all_results = [result for sublist in all_results for result in sublist]
-
-    #     # 将结果写入指定目录下的文件
-    #     filename = f"1000_seed_time_series_results_a_{alpha:.2f}.json"
-    #     filepath = os.path.join(output_dir, filename)
-        
-    #     with open(filepath, "w") as f:
-    #         json.dump(all_results, f, indent=1, separators=(',', ':'))
-    #     print(f"Results saved to: {filepath}")
+    # # Run every (alpha, seed) on a process pool; each finished chunk of seeds is
+    # # appended to Data/time_series_results_BR5_a_<alpha>.jsonl as it completes
+    # from sweep import run_sweep
+    # params = dict(Nt=Nt, Pin=Pin, Pout=Pout, mu=mu, Nseg=Nseg, num_cell=num_cell, cell_size=cell_size,
+    #               w1=w1, w2=w2, w3=w3, w4=w4, L=L)
+    # run_sweep(alpha_values, random_seeds, [5], params, "Data", chunk_size=50, output_format="npz",
+    #           checkpoint_every=500)
+    # # After an interruption, continue where the sweep stopped:
+    # # from sweep import resume; resume("Data")
+    # # The same sweep can be described in a config file and run without editing this
+    # # script: python sweep_cli.py sweep.json (--dry-run for the plan and its cost)
@@ -1,48 +1,82 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from solve_for_flow import solve_for_flow
 from cell_migration import cell_migration
 from realign_polarity import realign_polarity
-from plot_network import plot_network
-from make_segments import make_segments
-import copy
-import random
+from network import default_network
+from cell_state import CellState
+from random_streams import RandomStreams
+from profiling import stage_context, print_summary
 
 
 # Initialize segment cell structures
-def initialize_segments(Nseg, num_cell):
-    seg_cells = [{} for _ in range(Nseg)]
-    for seg in range(Nseg):
-        seg_cells[seg]['num'] = int(num_cell)  # Number of cells
-        seg_cells[seg]['polarity'] = [np.random.randn(2) for _ in range(num_cell)]  # Random polarity vectors
-        for v in seg_cells[seg]['polarity']:
-            v /= np.linalg.norm(v)  # Normalize to unit vectors
-        # seg_cells[seg]['migration'] = np.zeros(num_cell)  # Migration indicator
-    return seg_cells
+# rng is an np.random.Generator or RandomState (the global stream by default)
+def initialize_segments(Nseg, num_cell, rng=np.random):
+    polarity = rng.standard_normal((Nseg * int(num_cell), 2))  # Random polarity vectors
+    polarity /= np.linalg.norm(polarity, axis=1, keepdims=True)  # Normalize to unit vectors
+    seg = np.repeat(np.arange(Nseg), int(num_cell))  # Segment ID of each cell
+    return CellState(polarity, seg, Nseg)
 
 
 # Compute initial segment conductance and shear stress
+# Ncell may carry leading replica axes, e.g. (Nrep, Nseg)
 def compute_conductance(Nseg, Ncell, cell_size, mu, L):
-    D = np.zeros(Nseg)
-    G = np.zeros(Nseg)
-    H = np.zeros(Nseg)
-    for seg in range(Nseg):
-        if Ncell[seg] >= 1:
-            D[seg] = Ncell[seg] * cell_size / np.pi
-        else:
-            D[seg] = 0
-        G[seg] = (np.pi * D[seg]**4) / (128 * mu * L[seg])
-        if D[seg] != 0:
-            H[seg] = (32 * mu) / (np.pi * D[seg]**3)
+    Ncell = np.asarray(Ncell)
+    D = np.where(Ncell >= 1, Ncell * cell_size / np.pi, 0.0)
+    G = (np.pi * D**4) / (128 * mu * L)
+    with np.errstate(divide='ignore'):
+        H = np.where(D != 0, (32 * mu) / (np.pi * D**3), 0.0)
     return D, G, H
 
 
+class ConductanceModel:
+    """compute_conductance with the constant factors computed once.
+
+    Ncell is a small integer in every step, so D, pi * D**4 and H are
+    tabulated by cell count and only the division of pi * D**4 by the
+    per-segment 128 * mu * L is left per step. The table grows when a
+    larger count turns up; non-integer Ncell falls back to
+    compute_conductance. Results are identical to compute_conductance.
+    """
+
+    def __init__(self, Nseg, cell_size, mu, L, max_cells=64):
+        self.Nseg = Nseg
+        self.cell_size = cell_size
+        self.mu = mu
+        self.L = L
+        self.denominator = 128 * mu * L  # Per-segment factor of G
+        self._tabulate(max_cells)
+
+    def _tabulate(self, max_cells):
+        n = np.arange(max_cells + 1, dtype=float)
+        D = np.where(n >= 1, n * self.cell_size / np.pi, 0.0)
+        self.D_table = D
+        self.G_table = np.pi * D**4  # Numerator of G
+        with np.errstate(divide='ignore'):
+            self.H_table = np.where(D != 0, (32 * self.mu) / (np.pi * D**3), 0.0)
+
+    def __call__(self, Ncell):
+        """D, G, H of Ncell, which may carry leading replica axes like (Nrep, Nseg)."""
+        n = np.asarray(Ncell)
+        if n.dtype.kind not in "iu":  # e.g. float counts; check they are whole
+            n = n.astype(np.intp)
+            if (n != Ncell).any():
+                return compute_conductance(self.Nseg, Ncell, self.cell_size, self.mu, self.L)
+        if n.min(initial=0) < 0:
+            return compute_conductance(self.Nseg, Ncell, self.cell_size, self.mu, self.L)
+        if n.max(initial=0) >= len(self.D_table):
+            self._tabulate(2 * int(n.max()))
+        return self.D_table[n], self.G_table[n] / self.denominator, self.H_table[n]
+
+
 
 if __name__ == "__main__":
+    from plot_network import plot_network, NetworkRenderer
+
     # Set random seed for reproducibility
     seed = 7627
-    np.random.seed(seed)
-    random.seed(seed)
+    rng = RandomStreams(seed)
+    profiler = None  # profiling.StageProfiler() to time every stage of the loop
+    movie = None  # A directory for PNG frames or a video file, e.g. "run.gif", to record every step headless
     # Input parameters
     Nt = 40  # Number of time steps
     Pin = 100  # Inlet pressure (Pa)
@@ -71,16 +105,21 @@ if __name__ == "__main__":
     H = np.zeros(Nseg)  # Shear stress calculation factor
     tau = np.zeros(Nseg)  # Shear stress array
 
-    segments = make_segments(L)  # Generate segment structure
+    network = default_network(L)  # Generate the vessel network
 
-    seg_cells = initialize_segments(Nseg, num_cell)
+    cells = initialize_segments(Nseg, num_cell, rng.init)
 
     D, G, H = compute_conductance(Nseg, Ncell, cell_size, mu, L)
 
     # Solve for initial flow
     P, Q, tau = solve_for_flow(G, Pin, Pout, H)
 
-    # plot_network(segments, D, P, Q, seg_cells, tau)
+    # plot_network(network, D, P, Q, cells, tau)
+
+    stage = stage_context(profiler)
+    if profiler is not None:
+        profiler.start_run(seed)
+    renderer = NetworkRenderer(network, movie) if movie is not None else None
 
     # Time stepping for migration process
     for t in range(Nt):
@@ -88,23 +127,37 @@ if __name__ == "__main__":
         
         migrate = np.zeros(Nseg)
         
-        new_seg_cells = copy.deepcopy(seg_cells)
-        
-        for seg in range(Nseg):
-            seg_cells, new_seg_cells = realign_polarity(seg, Q, seg_cells, new_seg_cells, w1, w2, w3, w4)
-            seg_cells, new_seg_cells = cell_migration(seg, seg_cells, new_seg_cells, migrate, Q, branch_rule, branch_alpha, tau)
+        with stage("realign"):
+            cells = realign_polarity(Q, cells, w1, w2, w3, w4, rng=rng.polarity)
+        with stage("migration"):
+            cells = cell_migration(cells, migrate, Q, branch_rule, branch_alpha, tau, rng=rng.migration,
+                                   branch_rng=rng.branch)
         
-        seg_cells = copy.deepcopy(new_seg_cells)
+        with stage("swap"):
+            cells.swap()  # Next state becomes current
 
         ### Update Ncell
-        for seg in range(Nseg):
-            Ncell[seg] = seg_cells[seg]['num']
+        Ncell[:] = cells.counts
 
         # Update conductance and shear stress
-        D, G, H = compute_conductance(Nseg, Ncell, cell_size, mu, L)
+        with stage("conductance"):
+            D, G, H = compute_conductance(Nseg, Ncell, cell_size, mu, L)
         
         # Solve for flow with updated parameters
-        P, Q, tau = solve_for_flow(G, Pin, Pout, H)
+        with stage("flow"):
+            P, Q, tau = solve_for_flow(G, Pin, Pout, H)
         # Plot only every 20 time steps
-        if (t + 1) % 6 == 0:
-            plot_network(segments, D, P, Q, seg_cells, tau, t + 1)
\ No newline at end of file
+        if renderer is not None:
+            with stage("output"):
+                renderer.draw(D, P, Q, cells, tau, t + 1)
+        elif (t + 1) % 6 == 0:
+            with stage("output"):
+                plot_network(network, D, P, Q, cells, tau, t + 1)
+        if profiler is not None:
+            profiler.end_step(t + 1, len(cells), migrate.sum())
+
+    if renderer is not None:
+        renderer.close()
+    if profiler is not None:
+        profiler.end_run(Nt)
+        print_summary(profiler.summary())
\ No newline at end of file
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import subprocess
+import numpy as np
+
+# Timings of every stage of a simulation step and of whole runs, along the
+# axes that drive the cost of a sweep, and of starting a worker process
+# (axis "startup": a fresh interpreter importing each module). Results are JSON rows
+#   {"axis": ..., "value": ..., "stage": ..., "best": s, "median": s, "number": calls per repeat}
+# with the time of one call, plus the environment they were measured in, so
+# two revisions can be compared with compare_benchmarks.
+
+STAGES = ("initialize_segments", "realign_polarity", "cell_migration", "compute_conductance",
+          "conductance_model", "solve_for_flow", "store_output", "step")
+
+# Values of each scaling axis; the others stay at the model defaults
+# (8 cells per segment, the 40-segment network, Nt = 50, one seed)
+AXES = dict(num_cell=(2, 8, 32), Nseg=(40, 301, 3001), Nt=(10, 50, 200), seeds=(1, 10, 50))
+QUICK_AXES = dict(num_cell=(2, 8), Nseg=(40, 301), Nt=(10, 50), seeds=(1, 10))
+
+# Modules a worker process imports, timed from a fresh interpreter
+STARTUP_MODULES = ("abm_ec_simulation_v2", "abm_different_seed_loss_simulation", "ensemble", "sweep")
+
+# Parameters of the benchmarked runs
+PARAMS = dict(Pin=100, Pout=0, mu=3.5e-3, cell_size=5e-6, branch_rule=5, branch_alpha=0.45,
+              w1=0.3, w2=0.4, w3=0.2, w4=0.1)
+
+
+def time_call(function, repeat=5, min_time=0.02):
+    """Best and median time of one call of function, over repeat rounds of enough calls to last min_time."""
+    timer = timeit.Timer(function)
+    number = 1
+    while True:  # Like Timer.autorange, with a shorter target time
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    times = np.array(timer.repeat(repeat, number)) / number
+    return dict(best=float(times.min()), median=float(np.median(times)), number=number)
+
+
+def bench_network(Nseg):
+    """The default network for 40 segments, a ladder network of about Nseg segments otherwise."""
+    from network import default_network, ladder_network
+    return default_network() if Nseg == 40 else ladder_network(max((Nseg - 1) // 3, 1))
+
+
+def stage_timings(num_cell=8, network=None, repeat=5, seed=0):
+    """Time of each stage of one step on a network (the default one if None) at num_cell cells per segment."""
+    from abm_ec_simulation_v2 import initialize_segments, compute_conductance, ConductanceModel
+    from realign_polarity import realign_polarity, segment_axis
+    from cell_migration import cell_migration, migration_table, JunctionRegistry
+    from solve_for_flow import solve_for_flow, flow_system
+    from abm_different_seed_loss_simulation import store_output
+    from random_streams import RandomStreams
+    from network import DEFAULT_NETWORK
+
+    network = network or DEFAULT_NETWORK
+    p = PARAMS
+    Nseg, L = network.Nseg, network.length
+    rng = RandomStreams(seed)
+    system = flow_system(network)
+    table = migration_table(network)
+    axis = segment_axis(network)
+    junctions = JunctionRegistry(table[3], p['branch_rule'], p['branch_alpha'])
+    conductance = ConductanceModel(Nseg, p['cell_size'], p['mu'], L)
+
+    cells = initialize_segments(Nseg, num_cell, rng.init)
+    D, G, H = conductance(cells.counts)
+    P, Q, tau = solve_for_flow(G, p['Pin'], p['Pout'], H, system)
+    P1 = junctions.branch_probability(cells.counts, tau)
+    migrate = np.zeros(Nseg)
+    w = (p['w1'], p['w2'], p['w3'], p['w4'])
+
+    def step():
+        realign_polarity(Q, cells, *w, axis=axis, rng=rng.polarity)
+        cell_migration(cells, migrate, Q, p['branch_rule'], p['branch_alpha'], tau, table, junctions,
+                       rng.migration, rng.branch)
+        cells.swap()
+        D, G, H = conductance(cells.counts)
+        solve_for_flow(G, p['Pin'], p['Pout'], H, system)
+        store_output(seed, cells.counts, D, junctions.branch_probability(cells.counts, tau), 1)
+
+    stages = {
+        "initialize_segments": lambda: initialize_segments(Nseg, num_cell, rng.init),
+        "realign_polarity": lambda: realign_polarity(Q, cells, *w, axis=axis, rng=rng.polarity),
+        "cell_migration": lambda: cell_migration(cells, migrate, Q, p['branch_rule'], p['branch_alpha'], tau,
+                                                 table, junctions, rng.migration, rng.branch),
+        "compute_conductance": lambda: compute_conductance(Nseg, cells.counts, p['cell_size'], p['mu'], L),
+        "conductance_model": lambda: conductance(cells.counts),
+        "solve_for_flow": lambda: solve_for_flow(G.copy(), p['Pin'], p['Pout'], H, system),
+        "store_output": lambda: store_output(seed, cells.counts, D, P1, 1),
+        "step": step,
+    }
+    return {name: time_call(function, repeat) for name, function in stages.items()}
+
+
+def run_timing(Nt=50, seeds=1, num_cell=8, network=None, repeat=3):
+    """Time of run_simulation for every seed in turn and of run_ensemble for all seeds at once."""
+    from abm_different_seed_loss_simulation import run_simulation
+    from ensemble import run_ensemble
+    from network import DEFAULT_NETWORK
+
+    network = network or DEFAULT_NETWORK
+    p = PARAMS
+    args = (Nt, p['Pin'], p['Pout'], p['mu'], network.Nseg, num_cell, p['cell_size'], p['branch_rule'],
+            p['branch_alpha'], p['w1'], p['w2'], p['w3'], p['w4'], network.length)
+    seed_list = list(range(seeds))
+    return {"run_simulation": time_call(lambda: [run_simulation(s, *args, network=network) for s in seed_list],
+                                        repeat, min_time=0),
+            "run_ensemble": time_call(lambda: run_ensemble(seed_list, *args, network=network), repeat, min_time=0)}
+
+
+def startup_timings(modules=STARTUP_MODULES, repeat=5):
+    """Time to start a fresh interpreter and import each module, and whether that loaded matplotlib.
+
+    "python" is the interpreter alone, which the module times include.
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    timings = {}
+    for module in ("python",) + tuple(modules):
+        code = "import sys" if module == "python" else f"import sys, {module}"
+        command = [sys.executable, "-c", code + "; print('matplotlib' in sys.modules)"]
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            loaded = subprocess.run(command, capture_output=True, text=True, cwd=cwd, check=True).stdout.strip()
+            times.append(time.perf_counter() - start)
+        timings[module] = dict(best=min(times), median=float(np.median(times)), number=1,
+                               matplotlib=loaded == "True")
+    return timings
+
+
+def environment():
+    """Where the benchmarks ran: revision, versions and machine."""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    import scipy
+    return dict(revision=revision, time=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                numpy=np.__version__, scipy=scipy.__version__, machine=platform.machine(),
+                processor=platform.processor(), cpu_count=os.cpu_count(), platform=platform.platform())
+
+
+def run_benchmarks(axes=AXES, repeat=5, progress=True):
+    """Time the stages along num_cell and Nseg, whole runs along Nt and seeds, and the startup of a worker."""
+    rows = []
+
+    def add(axis, value, timings):
+        for stage, timing in timings.items():
+            rows.append(dict(axis=axis, value=value, stage=stage, **timing))
+        if progress:
+            print(f"{axis}={value}: " + ", ".join(f"{stage} {t['best'] * 1e6:.1f} us"
+                                                  for stage, t in timings.items()), flush=True)
+
+    for num_cell in axes.get("num_cell", ()):
+        add("num_cell", num_cell, stage_timings(num_cell, repeat=repeat))
+    for Nseg in axes.get("Nseg", ()):
+        network = bench_network(Nseg)
+        add("Nseg", network.Nseg, stage_timings(network=network, repeat=repeat))
+    for Nt in axes.get("Nt", ()):
+        add("Nt", Nt, run_timing(Nt, repeat=max(repeat // 2, 1)))
+    for seeds in axes.get("seeds", ()):
+        add("seeds", seeds, run_timing(seeds=seeds, repeat=max(repeat // 2, 1)))
+    add("startup", "import", startup_timings(repeat=repeat))
+    return dict(environment=environment(), results=rows)
+
+
+def save_benchmarks(path, benchmarks):
+    with open(path, "w") as f:
+        json.dump(benchmarks, f, indent=1)
+
+
+def load_benchmarks(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_benchmarks(old, new, threshold=0.1):
+    """Rows of (axis, value, stage, old best, new best, new / old) for the timings present in both.
+
+    A ratio above 1 + threshold is marked as a regression, below 1 - threshold as an improvement.
+    """
+    before = {(r["axis"], r["value"], r["stage"]): r["best"] for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        key = (r["axis"], r["value"], r["stage"])
+        if key in before:
+            ratio = r["best"] / before[key]
+            change = "regression" if ratio > 1 + threshold else "improvement" if ratio < 1 - threshold else ""
+            rows.append(dict(axis=key[0], value=key[1], stage=key[2], old=before[key], new=r["best"],
+                             ratio=ratio, change=change))
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time every stage of the simulation along its scaling axes.")
+    parser.add_argument("-o", "--output", default="benchmarks.json", help="JSON file to write the timings to")
+    parser.add_argument("--compare", metavar="OLD", help="timings of an earlier revision to compare against")
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller sizes")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    benchmarks = run_benchmarks(QUICK_AXES if args.quick else AXES, args.repeat)
+    save_benchmarks(args.output, benchmarks)
+    if args.compare:
+        rows = compare_benchmarks(load_benchmarks(args.compare), benchmarks)
+        for r in rows:
+            print(f"{r['axis']:>9} {r['value']:>6} {r['stage']:<20} {r['old'] * 1e6:10.1f} us "
+                  f"{r['new'] * 1e6:10.1f} us {r['ratio']:6.2f} {r['change']}")
+        sys.exit(1 if any(r["change"] == "regression" for r in rows) else 0)
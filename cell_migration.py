@@ -1,297 +1,285 @@
+import functools
 import numpy as np
+from network import DEFAULT_NETWORK
 
-def caculate_branch_probability(seg_cells, tau, branch_alpha):
-    n1 = seg_cells[14]['num']  # Number of cells in branch 15
-    n2 = seg_cells[39]['num']  # Number of cells in branch 40
-    tau1 = tau[14]  # Shear stress in branch 15
-    tau2 = tau[39]  # Shear stress in branch 40
+BIFURCATION = -1  # Destination marker for cells that reach the (first) bifurcation; bifurcation j is -1 - j
+BRANCH_DAUGHTERS = DEFAULT_NETWORK.bifurcations[0][2]  # Daughter branches at the bifurcation (branch 15 and 40)
+MCHANCE = 1  # Assume full migration probability for now
+
+def branch_probability(n1, n2, tau1, tau2, branch_alpha):
+    """BR5 probability of choosing the first daughter; accepts arrays (one entry per replica)."""
     # Calculate probabilities based on shear stress and cell number
-    P_tau1 = tau1 / (tau1 + tau2) if tau1 + tau2 != 0 else 0.5
-    # P_tau2 = tau2 / (tau1 + tau2) 
-    P_n1 = n1 / (n1 + n2) if n1 + n2 != 0 else 0.5
-    # P_n2 = n2 / (n1 + n2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        P_tau1 = np.where(tau1 + tau2 != 0, tau1 / (tau1 + tau2), 0.5)
+        P_n1 = np.where(n1 + n2 != 0, n1 / (n1 + n2), 0.5)
     P1 = branch_alpha * P_tau1 + (1 - branch_alpha) * P_n1
-    # P2 = branch_alpha * P_tau2 + (1 - branch_alpha) * P_n2
     return P1
 
-def cell_migration(seg, seg_cells, new_seg_cells, migrate, Q, branch_rule, branch_alpha=None, tau=None):
-    """Handle cellular migration in the agent-based model."""
+def caculate_branch_probability(cells, tau, branch_alpha, daughters=BRANCH_DAUGHTERS):
+    if daughters is None:  # Network without bifurcations
+        return float('nan')
+    first, second = daughters
+    n1 = cells.counts[first]  # Number of cells in branch 15
+    n2 = cells.counts[second]  # Number of cells in branch 40
+    tau1 = tau[first]  # Shear stress in branch 15
+    tau2 = tau[second]  # Shear stress in branch 40
+    return float(branch_probability(n1, n2, tau1, tau2, branch_alpha))
+
+
+def build_migration_table(network=None):
+    """Compile the network topology into per-segment migration lookup tables.
+
+    Returns (direction, forward, backward, daughters): a cell moves to
+    forward[seg] when the component of its polarity along the segment
+    direction is >= cell_size / 2 and to backward[seg] when it is
+    <= -cell_size / 2. Destination -1 - j marks bifurcation j, whose two
+    daughter segments are daughters[j].
+    """
+    if network is None:
+        network = DEFAULT_NETWORK
+    code = {(node, side): BIFURCATION - j for j, (node, side, _) in enumerate(network.bifurcations)}
+
+    def destination(seg, transition):
+        node, side, segs = transition
+        if (node, side) in code:
+            return code[node, side]
+        return segs[0] if segs else seg  # Cells stay put at a dead end
+
+    forward = np.zeros(network.Nseg, dtype=np.intp)
+    backward = np.zeros(network.Nseg, dtype=np.intp)
+    for seg in range(network.Nseg):
+        to_end, to_start = network.exits(seg)
+        forward[seg] = destination(seg, to_end)
+        backward[seg] = destination(seg, to_start)
+
+    daughters = np.array([segs for _, _, segs in network.bifurcations], dtype=np.intp).reshape(-1, 2)
+    return network.direction, forward, backward, daughters
+
+
+@functools.lru_cache(maxsize=16)
+def migration_table(network=None):
+    """Migration table of a network, built once per network."""
+    return build_migration_table(network)
+
+_MIGRATION_TABLE = migration_table()
+
+
+### Branching rules
+
+class BranchRule:
+    """Decision rule for cells arriving at a bifurcation.
+
+    first_probability gets the state of the two daughters of any number of
+    junctions as arrays (cell counts n1, n2, shear stress tau1, tau2, flow
+    Q1, Q2 and the junction alpha, possibly with leading replica axes) and
+    returns the probability that an arriving cell chooses the first
+    daughter. choose_first turns the probabilities of the arriving cells
+    into decisions; stochastic rules get one uniform draw u per cell.
+    """
+    stochastic = False  # Whether the rule draws a random number per arriving cell
+    needs_alpha = False  # Whether the rule needs branch_alpha
+
+    def first_probability(self, n1, n2, tau1, tau2, Q1, Q2, alpha):
+        raise NotImplementedError
+
+    def choose_first(self, P, u):
+        return u < P if self.stochastic else P > 0.5
+
+
+class ShearStressRule(BranchRule):
+    """BR1: choose the daughter with the higher shear stress."""
+
+    def first_probability(self, n1, n2, tau1, tau2, Q1, Q2, alpha):
+        return np.where(tau1 > tau2, 1.0, 0.0)
+
+
+class FixedRule(BranchRule):
+    """Fixed probability of the first daughter (BR2: never, BR3: even odds, BR4: biased towards it)."""
+
+    def __init__(self, p, stochastic=True):
+        self.p = p
+        self.stochastic = stochastic
+
+    def first_probability(self, n1, n2, tau1, tau2, Q1, Q2, alpha):
+        return np.full(np.shape(tau1), self.p)
+
+
+class WeightedRule(BranchRule):
+    """BR5: alpha-weighted average of the shear stress and cell number fractions."""
+    stochastic = True
+    needs_alpha = True
+
+    def first_probability(self, n1, n2, tau1, tau2, Q1, Q2, alpha):
+        return branch_probability(n1, n2, tau1, tau2, alpha)
+
+
+class FunctionRule(BranchRule):
+    """Branching rule from a function f(n1, n2, tau1, tau2, Q1, Q2, alpha) returning probabilities."""
+
+    def __init__(self, function, stochastic=True, needs_alpha=False):
+        self.function = function
+        self.stochastic = stochastic
+        self.needs_alpha = needs_alpha
+
+    def first_probability(self, n1, n2, tau1, tau2, Q1, Q2, alpha):
+        return self.function(n1, n2, tau1, tau2, Q1, Q2, alpha)
+
+
+BRANCH_RULES = {
+    1: ShearStressRule(),  # BR1: Choose based on shear stress
+    2: FixedRule(0.0, stochastic=False),  # BR2: Always choose branch 40
+    3: FixedRule(0.5),  # BR3: Random choice with equal probability
+    4: FixedRule(0.7),  # BR4: Biased probability towards high-flow branch
+    5: WeightedRule(),  # BR5: Weighted average of shear stress and cell number
+}
+
+
+def register_branch_rule(key, rule):
+    """Make a BranchRule (or a probability function, see FunctionRule) available as branch_rule=key."""
+    BRANCH_RULES[key] = rule if isinstance(rule, BranchRule) else FunctionRule(rule)
+
+
+def get_branch_rule(key):
+    """The BranchRule registered as key (a BranchRule is returned as it is)."""
+    if isinstance(key, BranchRule):
+        return key
+    try:
+        return BRANCH_RULES[key]
+    except (KeyError, TypeError):
+        raise ValueError(f"Unknown branch rule: {key}") from None
+
+
+def first_branch_probability(branch_rule, n1, n2, tau1, tau2, branch_alpha=None, Q1=None, Q2=None):
+    """Probability that a cell arriving at the bifurcation chooses the first daughter."""
+    return get_branch_rule(branch_rule).first_probability(n1, n2, tau1, tau2, Q1, Q2, branch_alpha)
+
+
+class JunctionRegistry:
+    """Branching rule and alpha of every bifurcation of a network.
+
+    Bifurcation j (numbered as in the migration table) sends cells to
+    daughters[j] according to rule[j] (a key of BRANCH_RULES or a BranchRule) with
+    parameter alpha[j]. branch_rule and branch_alpha are either one value
+    for all junctions or one value per junction. All methods accept
+    counts, tau and Q with leading replica axes; each rule is evaluated
+    once for all of its junctions.
+    """
+
+    def __init__(self, daughters, branch_rule, branch_alpha=None):
+        self.daughters = np.asarray(daughters, dtype=np.intp).reshape(-1, 2)
+        Nj = len(self.daughters)
+        self.rule = list(branch_rule) if np.ndim(branch_rule) else [branch_rule] * Nj
+        alpha = np.nan if branch_alpha is None else branch_alpha
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype=float), (Nj,)).copy()
+        if len(self.rule) != Nj:
+            raise ValueError(f"Got {len(self.rule)} branch rules for {Nj} junctions")
+
+        # Junctions grouped by rule
+        self._groups = []
+        for key in dict.fromkeys(self.rule):
+            rule = get_branch_rule(key)
+            at = np.array([r == key for r in self.rule])
+            if rule.needs_alpha and np.isnan(self.alpha[at]).any():
+                raise ValueError(f"Branch rule {key} needs a branch_alpha")
+            self._groups.append((rule, at))
+        self.stochastic = np.zeros(Nj, dtype=bool)
+        for rule, at in self._groups:
+            self.stochastic[at] = rule.stochastic
+
+    @classmethod
+    def from_network(cls, network, branch_rule, branch_alpha=None):
+        return cls(migration_table(network)[3], branch_rule, branch_alpha)
+
+    def __len__(self):
+        return len(self.daughters)
+
+    def _daughter_state(self, counts, tau, Q=None):
+        first, second = self.daughters[:, 0], self.daughters[:, 1]
+        Q1, Q2 = (None, None) if Q is None else (Q[..., first], Q[..., second])
+        return counts[..., first], counts[..., second], tau[..., first], tau[..., second], Q1, Q2
+
+    def branch_probability(self, counts, tau):
+        """BR5 probability of each junction's first daughter with its alpha (the recorded P1)."""
+        return branch_probability(*self._daughter_state(counts, tau)[:4], self.alpha)
+
+    def first_probability(self, counts, tau, Q=None):
+        """Probability that a cell arriving at each junction chooses its first daughter under the junction's rule."""
+        state = self._daughter_state(counts, tau, Q)
+        P = np.empty(np.shape(state[2]))
+        for rule, at in self._groups:
+            P[..., at] = rule.first_probability(*(None if x is None else x[..., at] for x in state), self.alpha[at])
+        return P
+
+    def choose(self, junction, P, u):
+        """Daughter of every arriving cell.
+
+        junction is the bifurcation of each cell, P its probability of the
+        first daughter and u uniform draws for the cells at stochastic
+        junctions, in cell order.
+        """
+        stochastic = self.stochastic[junction]
+        u_all = np.zeros(len(junction))
+        u_all[stochastic] = u
+        choose_first = np.zeros(len(junction), dtype=bool)
+        for rule, at in self._groups:
+            arriving = at[junction]
+            choose_first[arriving] = rule.choose_first(P[arriving], u_all[arriving])
+        return np.where(choose_first, self.daughters[junction, 0], self.daughters[junction, 1])
+
+
+def choose_branch(junction, cells, junctions, tau, Q=None, rng=None):
+    """Pick a daughter branch for every cell arriving at a bifurcation of the JunctionRegistry.
+
+    The uniform draws come from rng (an np.random.Generator or RandomState,
+    the global stream if None).
+    """
+    P = junctions.first_probability(cells.counts, tau, Q)[junction]
+
+    # Randomly choose a branch based on probabilities
+    u = (np.random if rng is None else rng).random(np.count_nonzero(junctions.stochastic[junction]))
+    return junctions.choose(junction, P, u)
+
+
+def migration_targets(cells, table=None):
+    """Destination of every cell from its polarity, with -1 - j for cells reaching bifurcation j."""
 
     cell_size = 10e-6  # Set the size of each cell (m)
-    mchance = 1  # Assume full migration probability for now
-
-    # Check if the segment contains cells
-    if seg_cells[seg]['num'] != 0:
-        for cell in range(int(seg_cells[seg]['num'])-1, -1, -1):
-            mcell = np.random.rand()
-            if mcell <= mchance:  # Determine if cell migrates
-                polar_vect = seg_cells[seg]['polarity'][cell]
-                migrate_vect = cell_size * polar_vect
-
-                # Migration logic based on segment index
-                ### Handle segments 0 and 20
-                if seg == 0:
-                    if migrate_vect[1] >= cell_size / 2:
-                        
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-                          
-                        new_seg_cells[19]['num'] += 1
-                        new_seg_cells[19]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                        
-                        migrate[seg] += 1
-                elif seg == 20:
-                    if migrate_vect[1] >= cell_size / 2:
-                          
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-
-                        new_seg_cells[4]['num'] += 1
-                        new_seg_cells[4]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                ### Handle segments 1-3 and 21-24
-                elif 1 <= seg <= 4 or (21 <= seg <= 24):
-                    if migrate_vect[1] >= cell_size / 2:
-                          
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-                        
-                        new_seg_cells[seg-1]['num'] += 1
-                        new_seg_cells[seg-1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                ### Handle segments 5-14 and 25-34
-                elif 5 <= seg <= 14 or (25 <= seg <= 34):
-                    if migrate_vect[0] >= cell_size / 2:
-                        
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[0] <= -cell_size / 2:
-                        
-                        new_seg_cells[seg-1]['num'] += 1
-                        new_seg_cells[seg-1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                ### Handle segments 16-18 and 35-38
-                elif 16 <= seg <= 18 or (35 <= seg <= 38):
-                    if migrate_vect[1] >= cell_size / 2:
-                        
-                        new_seg_cells[seg-1]['num'] += 1
-                        new_seg_cells[seg-1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-                        
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                ### Handle segment 19
-                elif seg == 19:
-                    if migrate_vect[1] >= cell_size / 2:
-                        
-                        new_seg_cells[seg-1]['num'] += 1
-                        new_seg_cells[seg-1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-                        
-                        new_seg_cells[0]['num'] += 1
-                        new_seg_cells[0]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                ### Handle segment 39
-                elif seg == 39:
-                    if migrate_vect[1] >= cell_size / 2:
-
-                        new_seg_cells[seg-1]['num'] += 1
-                        new_seg_cells[seg-1]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] <= -cell_size / 2:
-
-                        new_seg_cells[15]['num'] += 1
-                        new_seg_cells[15]['polarity'].append(polar_vect)
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-
-
-                ### Handle bifurcation segment 15
-                elif seg == 15:
-                    if migrate_vect[1] <= -cell_size / 2:
-                        
-                        new_seg_cells[seg+1]['num'] += 1
-                        new_seg_cells[seg+1]['polarity'].append(polar_vect)  
-                        new_seg_cells[seg]['polarity'].pop(cell)
-                                
-                        migrate[seg] += 1
-                    elif migrate_vect[1] >= cell_size / 2:
-                        
-                        new_seg_cells[seg]['polarity'].pop(cell)       
-                        migrate[seg] += 1
-
-                        # BR1: Choose based on shear stress
-                        if branch_rule == 1:
-                            if tau[14] > tau[39]:
-                                new_seg_cells[14]['num'] += 1  # Choose branch 15
-                                new_seg_cells[14]['polarity'].append(polar_vect)
-                            else:
-                                new_seg_cells[39]['num'] += 1  # Choose branch 40
-                                new_seg_cells[39]['polarity'].append(polar_vect)
-                        
-                        # BR2: Choose the branch with the smallest direction change
-                        elif branch_rule == 2:
-                            # Calculate angle between parent and child branches
-                            # theta1 = np.arccos(np.dot(polar_vect, [-1, 0]))  # Angle for branch 15
-                            # theta2 = np.arccos(np.dot(polar_vect, [0, 1]))  # Angle for branch 40
-                            # if theta1 < theta2:
-                            #     new_seg_cells[14]['num'] += 1  # Choose branch 15
-                            #     new_seg_cells[14]['polarity'].append(polar_vect)
-                            # else:
-                            #     new_seg_cells[39]['num'] += 1  # Choose branch 40
-                            #     new_seg_cells[39]['polarity'].append(polar_vect)
-                            new_seg_cells[39]['num'] += 1  # Choose branch 40
-                            new_seg_cells[39]['polarity'].append(polar_vect)
-                            
-                        
-                        # BR3: Random choice with equal probability
-                        elif branch_rule == 3:
-                            r = np.random.rand()
-                            if r < 0.5:
-                                new_seg_cells[14]['num'] += 1  # Choose branch 15
-                                new_seg_cells[14]['polarity'].append(polar_vect)
-                            else:
-                                new_seg_cells[39]['num'] += 1  # Choose branch 40
-                                new_seg_cells[39]['polarity'].append(polar_vect)
-                
-                        # BR4: Biased probability towards high-flow branch
-                        elif branch_rule == 4:
-                            r = np.random.rand()
-                            if r < 0.7:
-                                new_seg_cells[14]['num'] += 1  # Choose branch 15
-                                new_seg_cells[14]['polarity'].append(polar_vect)
-                            else:
-                                new_seg_cells[39]['num'] += 1  # Choose branch 40
-                                new_seg_cells[39]['polarity'].append(polar_vect)
-                        
-                        # BR5: Weighted average of shear stress and cell number
-                        elif branch_rule == 5:
-                            P1 = caculate_branch_probability(seg_cells, tau, branch_alpha)
-
-                            # Randomly choose a branch based on probabilities
-                            r = np.random.rand()
-                            # print(r)
-                            if r < P1:
-                                new_seg_cells[14]['num'] += 1  # Choose branch 15
-                                new_seg_cells[14]['polarity'].append(polar_vect)
-                            else:
-                                new_seg_cells[39]['num'] += 1  # Choose branch 40
-                                new_seg_cells[39]['polarity'].append(polar_vect)
-
-                # elif seg == 4:
-                #     if migrate_vect[1] <= -cell_size / 2:
-                        
-                #         new_seg_cells[seg-1]['num'] += 1
-                #         new_seg_cells[seg-1]['polarity'].append(polar_vect)  
-                #         new_seg_cells[seg]['polarity'].pop(cell)
-                #         migrate[seg] += 1
-                        
-                #     elif migrate_vect[1] >= cell_size / 2:
-                          
-                #         new_seg_cells[seg]['polarity'].pop(cell)       
-                #         migrate[seg] += 1
-
-                #         # BR1: Choose based on shear stress
-                #         if branch_rule == 1:
-                #             print(tau[5], tau[20])
-                #             if tau[5] > tau[20]:
-                #                 new_seg_cells[5]['num'] += 1  # Choose branch 5
-                #                 new_seg_cells[5]['polarity'].append(polar_vect)
-                #             else:
-                #                 new_seg_cells[20]['num'] += 1  # Choose branch 20
-                #                 new_seg_cells[20]['polarity'].append(polar_vect)
-                        
-                #         # BR2: Choose the branch with the smallest direction change
-                #         elif branch_rule == 2:
-                #             # Calculate angle between parent and child branches
-                #             theta1 = np.arccos(np.dot(polar_vect, [1, 0]))  # Angle for branch 5
-                #             theta2 = np.arccos(np.dot(polar_vect, [0, 1]))  # Angle for branch 20
-                #             if theta1 < theta2:
-                #                 new_seg_cells[5]['num'] += 1  # Choose branch 5
-                #                 new_seg_cells[5]['polarity'].append(polar_vect)
-                #             else:
-                #                 new_seg_cells[20]['num'] += 1  # Choose branch 20
-                #                 new_seg_cells[20]['polarity'].append(polar_vect)
-                        
-                #         # BR3: Random choice with equal probability
-                #         elif branch_rule == 3:
-                #             r = np.random.rand()
-                #             if r < 0.5:
-                #                 new_seg_cells[5]['num'] += 1  # Choose branch 5
-                #                 new_seg_cells[5]['polarity'].append(polar_vect)
-                #             else:
-                #                 new_seg_cells[20]['num'] += 1  # Choose branch 20
-                #                 new_seg_cells[20]['polarity'].append(polar_vect)
-                
-                #         # BR4: Biased probability towards high-flow branch
-                #         elif branch_rule == 4:
-                #             r = np.random.rand()
-                #             if r < 0.7:
-                #                 new_seg_cells[5]['num'] += 1  # Choose branch 5
-                #                 new_seg_cells[5]['polarity'].append(polar_vect)
-                #             else:
-                #                 new_seg_cells[20]['num'] += 1  # Choose branch 20
-                #                 new_seg_cells[20]['polarity'].append(polar_vect)
-                        
-                #         # BR5: Weighted average of shear stress and cell number
-                #         elif branch_rule == 5:
-                #             n1 = seg_cells[5]['num']  # Number of cells in branch 5
-                #             n2 = seg_cells[20]['num']  # Number of cells in branch 20
-                #             tau1 = tau[5]  # Shear stress in branch 5
-                #             tau2 = tau[20]  # Shear stress in branch 20
-                #             # Calculate probabilities based on shear stress and cell number
-                #             P_tau1 = tau1 / (tau1 + tau2)
-                #             P_tau2 = tau2 / (tau1 + tau2)
-                #             P_n1 = n1 / (n1 + n2)
-                #             P_n2 = n2 / (n1 + n2)
-                #             P1 = branch_alpha * P_tau1 + (1 - branch_alpha) * P_n1
-                #             P2 = branch_alpha * P_tau2 + (1 - branch_alpha) * P_n2
-                            
-                #             # Randomly choose a branch based on probabilities
-                #             r = np.random.rand()
-                #             if r < P1:
-                #                 new_seg_cells[5]['num'] += 1  # Choose branch 5
-                #                 new_seg_cells[5]['polarity'].append(polar_vect)
-                #             else:
-                #                 new_seg_cells[20]['num'] += 1  # Choose branch 20
-                #                 new_seg_cells[20]['polarity'].append(polar_vect)       
-
-        new_seg_cells[seg]['num'] -= migrate[seg]
-
-    return seg_cells, new_seg_cells
+
+    direction, forward, backward, _ = _MIGRATION_TABLE if table is None else table
+
+    seg = cells.seg
+    polar = cells.polarity
+    migrate_vect = cell_size * (polar[:, 0] * direction[seg, 0] + polar[:, 1] * direction[seg, 1])
+
+    return np.where(migrate_vect >= cell_size / 2, forward[seg],
+                    np.where(migrate_vect <= -cell_size / 2, backward[seg], seg))
+
+
+def cell_migration(cells, migrate, Q, branch_rule, branch_alpha=None, tau=None, table=None, junctions=None,
+                   rng=None, branch_rng=None):
+    """Handle cellular migration in the agent-based model.
+
+    Every cell's destination is computed in one pass from the migration
+    table and written to ``cells.dest``; call ``cells.swap()`` to apply it.
+    Bifurcations are decided by ``junctions`` (a JunctionRegistry), or by
+    branch_rule and branch_alpha at every junction if it is None.
+    The migration chance is drawn from rng and the branch decisions from
+    branch_rng (rng if None); both use the global stream if None.
+    """
+    seg = cells.seg
+    dest = migration_targets(cells, table)
+    if MCHANCE < 1:  # Determine which cells migrate
+        dest = np.where((np.random if rng is None else rng).random(len(cells)) <= MCHANCE, dest, seg)
+
+    ### Handle the bifurcations
+    branching = np.flatnonzero(dest < 0)
+    if len(branching) != 0:
+        if junctions is None:
+            junctions = JunctionRegistry((_MIGRATION_TABLE if table is None else table)[3], branch_rule, branch_alpha)
+        dest[branching] = choose_branch(BIFURCATION - dest[branching], cells, junctions, tau, Q,
+                                        rng if branch_rng is None else branch_rng)
+
+    migrate += np.bincount(seg[dest != seg], minlength=cells.Nseg)
+    cells.dest[:] = dest
+
+    return cells
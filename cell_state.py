@@ -0,0 +1,52 @@
+import numpy as np
+
+class CellState:
+    """Structure-of-arrays store for the endothelial cells of the network.
+
+    All polarities live in one contiguous (Ncells, 2) array, grouped by
+    segment, so the cells of segment ``seg`` are
+    ``polarity[offsets[seg]:offsets[seg + 1]]``.
+
+    The store is double-buffered: during a step cells are realigned in
+    place and each cell's new segment is written to ``dest``; ``swap``
+    then scatters the cells into the back buffer grouped by their new
+    segment and makes it the current one. No buffers are reallocated
+    between steps.
+    """
+
+    def __init__(self, polarity, seg, Nseg):
+        self.Nseg = Nseg
+        self.polarity = np.array(polarity, dtype=float).reshape(-1, 2)  # Polarity vector per cell
+        self.seg = np.array(seg, dtype=np.intp)  # Segment ID per cell
+        self.dest = self.seg.copy()  # Segment each cell ends the step in
+        self._polarity_next = np.empty_like(self.polarity)  # Back buffer
+        self.offsets = np.zeros(Nseg + 1, dtype=np.intp)  # Start of each segment's cells
+        self._update_offsets()
+
+    def _update_offsets(self):
+        self.counts = np.bincount(self.seg, minlength=self.Nseg)  # Number of cells per segment
+        np.cumsum(self.counts, out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.seg)
+
+    def segment(self, seg):
+        """Slice selecting the cells of a segment."""
+        return slice(self.offsets[seg], self.offsets[seg + 1])
+
+    def segment_polarity(self, seg):
+        """View of the polarity vectors of the cells in a segment."""
+        return self.polarity[self.segment(seg)]
+
+    def swap(self):
+        """Apply the destinations in ``dest`` and swap the buffers.
+
+        Cells are regrouped with a stable sort, so cells keep their
+        relative order within each new segment.
+        """
+        order = np.argsort(self.dest, kind='stable')
+        np.take(self.polarity, order, axis=0, out=self._polarity_next)
+        np.take(self.dest, order, out=self.seg)
+        self.polarity, self._polarity_next = self._polarity_next, self.polarity
+        self.dest[:] = self.seg
+        self._update_offsets()
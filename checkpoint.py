@@ -0,0 +1,67 @@
+import os
+import json
+import pickle
+
+# Checkpoints of interrupted work
+#   run checkpoint   pickled state of a run_ensemble batch part way through
+#                    (cell arrays, random stream states, timestep, records so far)
+#   sweep manifest   checkpoints/completed.jsonl in a sweep's output directory,
+#                    one line per chunk of seeds written to the results
+# Files are replaced atomically, so a run killed while writing keeps the
+# previous checkpoint.
+
+def save_checkpoint(path, state):
+    """Pickle a state dictionary to path, replacing any earlier checkpoint atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    """State saved by save_checkpoint, or None if there is no checkpoint at path."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class SweepManifest:
+    """Record of the chunks of a sweep whose results are safely on disk.
+
+    Each line holds the chunk index and, for JSON-lines output, the size of
+    the result file after the chunk was appended, so a partly written
+    chunk can be cut off again on resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}  # Chunk index -> recorded line
+        if os.path.exists(path):
+            with open(path) as f:
+                text = f.read()
+            lines = text.splitlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # Line cut off by the interruption
+                    continue
+                self.done[entry["chunk"]] = entry
+            if len(self.done) != len(lines) or not text.endswith("\n"):  # Repair a cut-off last line
+                with open(path, "w") as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in self.done.values())
+
+    def record(self, chunk, size=None):
+        entry = {"chunk": chunk, "size": size}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[chunk] = entry
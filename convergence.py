@@ -0,0 +1,82 @@
+import numpy as np
+from network import branch_daughters
+
+STOP_REASONS = ("branch_loss", "steady", "cycle")
+
+
+class ConvergenceMonitor:
+    """Detects runs whose cell distribution has resolved, so they can stop early.
+
+    A run stops when
+      * branch_loss: one of the daughter branches has no cells left,
+      * steady: Ncell has not changed for ``window`` consecutive steps,
+      * cycle: Ncell has repeated with a period of 2 ... ``max_period``
+        steps for ``window`` consecutive steps.
+    window=0 disables the steady and cycle checks. Branch loss is not
+    strictly absorbing (a cell may still wander back in), so stopping on it
+    is an approximation of the full run.
+
+    One monitor tracks a batch of runs; update() takes Ncell of every run
+    still active, returns which of them stop now and drops those from the
+    batch. The reason and step of every run are kept in ``reason`` ("" while
+    running) and ``step`` (-1 while running).
+
+    The daughter branches watched for branch loss are ``branches`` if given,
+    else those of the first bifurcation of ``network``, else those of the
+    network the runs use (passed to start).
+    """
+
+    def __init__(self, branch_loss=True, window=0, max_period=1, branches=None, network=None):
+        self.branch_loss = branch_loss
+        self.window = window
+        self.max_period = max_period
+        if branches is None and network is not None:
+            branches = branch_daughters(network)
+        self.branches = None if branches is None else list(branches)
+        self.start()
+
+    def to_dict(self):
+        """Settings of the monitor (without the state of the runs it tracks)."""
+        return dict(branch_loss=self.branch_loss, window=self.window, max_period=self.max_period,
+                    branches=None if self.branches is None else [int(b) for b in self.branches])
+
+    def start(self, Nrep=1, network=None):
+        """Reset the monitor for a new batch of Nrep runs on network (the default network if None)."""
+        self._branches = self.branches
+        if self._branches is None and self.branch_loss:
+            self._branches = branch_daughters(network)
+        self.reason = np.full(Nrep, "", dtype="<U11")
+        self.step = np.full(Nrep, -1)
+        self.active = np.arange(Nrep)  # Run index of each row passed to update
+        self._history = []  # Recent Ncell of the active runs, newest last
+
+    def update(self, t, Ncell):
+        """Check the state after step t; Ncell has shape (Nactive, Nseg) or (Nseg,) for one run."""
+        Ncell = np.atleast_2d(Ncell)
+        stopped = np.zeros(len(Ncell), dtype=bool)
+        reason = np.full(len(Ncell), "", dtype=self.reason.dtype)
+
+        if self.branch_loss:
+            lost = (Ncell[:, self._branches] == 0).any(axis=1)
+            reason[lost] = "branch_loss"
+            stopped |= lost
+
+        if self.window:
+            self._history.append(Ncell.copy())
+            del self._history[:-(self.window + self.max_period)]
+            history = np.array(self._history)
+            n = len(history)
+            for period in range(1, min(self.max_period, n - self.window) + 1):
+                # Each of the last `window` states equals the one `period` steps before it
+                repeats = (history[n - self.window:] == history[n - self.window - period:n - period]).all(axis=(0, 2))
+                new = repeats & ~stopped
+                reason[new] = "steady" if period == 1 else "cycle"
+                stopped |= new
+
+        if stopped.any():
+            runs = self.active[stopped]
+            self.reason[runs] = reason[stopped]
+            self.step[runs] = t
+            self.active = self.active[~stopped]
+            self._history = [h[~stopped] for h in self._history]
+        return stopped
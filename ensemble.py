@@ -0,0 +1,211 @@
+import numpy as np
+from cell_state import CellState
+from cell_migration import BIFURCATION, MCHANCE, JunctionRegistry, migration_table, migration_targets
+from realign_polarity import realign_polarity, segment_axis
+from solve_for_flow import flow_system, solve_for_flow_batch
+from abm_ec_simulation_v2 import initialize_segments, ConductanceModel
+from abm_different_seed_loss_simulation import store_output, stop_record
+from random_streams import RandomStreams
+from checkpoint import save_checkpoint, load_checkpoint, remove_checkpoint
+from profiling import stage_context
+
+# Replica r of an ensemble owns segments r * Nseg ... (r + 1) * Nseg - 1 of one
+# combined CellState, so the whole ensemble moves through the same kernels as
+# a single network. Every replica draws from its own RandomStreams, exactly as
+# run_simulation does for its seed, which keeps the per-seed results identical
+# to the serial path whatever the batch layout.
+
+def tile_migration_table(table, Nrep, Nseg):
+    """Repeat a migration table for Nrep disjoint copies of the network.
+
+    Bifurcation markers are kept as they are; daughters stay local to a replica.
+    """
+    direction, forward, backward, daughters = table
+    shift = np.repeat(np.arange(Nrep) * Nseg, Nseg)
+    tile = lambda dest: np.where(np.tile(dest, Nrep) < 0, np.tile(dest, Nrep), np.tile(dest, Nrep) + shift)
+    return np.tile(direction, (Nrep, 1)), tile(forward), tile(backward), daughters
+
+
+def drop_replicas(cells, keep, Nseg):
+    """CellState holding only the replicas where keep is True, renumbered in order."""
+    new_index = np.cumsum(keep) - 1
+    rep = cells.seg // Nseg
+    mask = keep[rep]
+    return CellState(cells.polarity[mask], new_index[rep[mask]] * Nseg + cells.seg[mask] % Nseg,
+                     int(keep.sum()) * Nseg)
+
+
+### Run one simulation per seed in lockstep, with the seeds as a leading array axis
+def run_ensemble(seeds, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha, w1, w2, w3, w4, L,
+                 monitor=None, network=None, legacy_rng=False, checkpoint=None, checkpoint_every=0,
+                 profiler=None, observer=None):
+    """Returns the time series of every seed, as run_simulation would for that seed.
+
+    legacy_rng=True draws from RandomStreams(seed, legacy=True), as
+    run_simulation does when given those streams.
+
+    With a ConvergenceMonitor, replicas that stop are padded with their final
+    state and removed from the batch, so they cost nothing afterwards.
+
+    With a checkpoint path, the state of the batch (cells, random streams,
+    timestep and the records so far) is saved there every checkpoint_every
+    steps. A call whose checkpoint exists continues from it and gives the
+    same results as an uninterrupted run; the checkpoint is removed once
+    the batch is finished.
+
+    A profiling.StageProfiler records the stages of every step of the
+    batch as one run of its first seed with len(seeds) replicas.
+
+    With an observer (see observers.py) the state of every replica after
+    every step is passed to it instead of being kept, and None is
+    returned. Its sinks are not saved in checkpoints, so it cannot be
+    combined with checkpoint.
+    """
+    if observer is not None and checkpoint is not None:
+        raise ValueError("An observer cannot be combined with a checkpoint")
+    Nrep = len(seeds)
+    rngs = [RandomStreams(seed, legacy_rng) for seed in seeds]
+    system = flow_system(network)
+    network_table = migration_table(network)
+    junctions = JunctionRegistry(network_table[3], branch_rule, branch_alpha)
+    conductance = ConductanceModel(Nseg, cell_size, mu, L)
+    state = load_checkpoint(checkpoint) if checkpoint is not None else None
+
+    if state is None:
+        # Initialize every replica from its own stream and combine them
+        replicas = [initialize_segments(Nseg, num_cell, rng.init) for rng in rngs]
+        n_rep = len(replicas[0])  # Cells per replica (conserved by migration)
+        cells = CellState(np.concatenate([c.polarity for c in replicas]),
+                          np.concatenate([c.seg + r * Nseg for r, c in enumerate(replicas)]), Nrep * Nseg)
+        active = np.arange(Nrep)  # Seed index of each replica still running
+        t_start = 0
+    else:
+        # Continue the replicas still running at the checkpoint
+        if list(state["seeds"]) != list(seeds):
+            raise ValueError(f"Checkpoint {checkpoint} belongs to other seeds")
+        active, t_start, n_rep = state["active"], state["t"], state["n_rep"]
+        rngs = [rngs[i] for i in active]
+        for rng, rng_state in zip(rngs, state["rng"]):
+            rng.set_state(rng_state)
+        Nrep = len(active)
+        cells = CellState(state["polarity"], state["seg"], Nrep * Nseg)
+        if monitor is not None:
+            monitor.__dict__.update(state["monitor"])
+    axis = np.tile(segment_axis(network), (Nrep, 1))
+    table = tile_migration_table(network_table, Nrep, Nseg)
+
+    # Compute initial conductance, flow and shear stress for all replicas
+    counts = cells.counts.reshape(Nrep, Nseg)
+    D, G, H = conductance(counts)
+    P, Q, tau = solve_for_flow_batch(G, Pin, Pout, H, system)
+    P1 = junctions.branch_probability(counts, tau)
+
+    if state is None:
+        # Store initial state
+        if observer is None:
+            results = [[store_output(seed, counts[r], D[r], P1[r], 0)] for r, seed in enumerate(seeds)]
+        else:
+            results = None
+            for r, seed in enumerate(seeds):
+                observer.update(seed, 0, counts[r], D[r], P1[r])
+        if monitor is not None:
+            monitor.start(Nrep, network)
+    else:
+        results = state["results"]
+
+    stage = stage_context(profiler)
+    if profiler is not None:
+        profiler.start_run(seeds[0], len(seeds))
+        t_last = t_start
+
+    # Time-stepping loop
+    for t in range(t_start, Nt):
+        if checkpoint is not None and checkpoint_every and t > t_start and t % checkpoint_every == 0:
+            with stage("checkpoint"):
+                save_checkpoint(checkpoint, dict(seeds=list(seeds), t=t, active=active, n_rep=n_rep,
+                                                 polarity=cells.polarity, seg=cells.seg,
+                                                 rng=[rng.get_state() for rng in rngs], results=results,
+                                                 monitor=None if monitor is None else vars(monitor)))
+
+        if monitor is not None:
+            stopped = monitor.update(t, counts)
+            if stopped.any():
+                # Pad the stopped replicas and drop them from the batch
+                for r in np.flatnonzero(stopped):
+                    i = active[r]
+                    if observer is None:
+                        results[i] += [store_output(seeds[i], counts[r], D[r], P1[r], t_pad)
+                                       for t_pad in range(t + 1, Nt + 1)]
+                    else:
+                        observer.finish(seeds[i], stop_record(monitor.reason[i], monitor.step[i]))
+                keep = ~stopped
+                active = active[keep]
+                if len(active) == 0:
+                    break
+                rngs = [rng for rng, k in zip(rngs, keep) if k]
+                cells = drop_replicas(cells, keep, Nseg)
+                Nrep = len(active)
+                axis = np.tile(segment_axis(network), (Nrep, 1))
+                table = tile_migration_table(network_table, Nrep, Nseg)
+                counts, D, Q, tau, P1 = counts[keep], D[keep], Q[keep], tau[keep], P1[keep]
+
+        with stage("realign"):
+            noise = np.concatenate([rng.polarity.standard_normal((n_rep, 2)) for rng in rngs]) if w4 != 0 else None
+            cells = realign_polarity(Q.ravel(), cells, w1, w2, w3, w4, axis=axis, noise=noise)
+
+        with stage("migration"):
+            dest = migration_targets(cells, table)
+            if MCHANCE < 1:  # Determine which cells migrate
+                u = np.concatenate([rng.migration.random(n_rep) for rng in rngs])
+                dest = np.where(u <= MCHANCE, dest, cells.seg)
+
+            ### Handle the bifurcations in every replica at once
+            branching = np.flatnonzero(dest < 0)
+            if len(branching) != 0:
+                junction = BIFURCATION - dest[branching]
+                rep = branching // n_rep
+                P = junctions.first_probability(counts, tau, Q)[rep, junction]
+                arrivals = np.bincount(rep[junctions.stochastic[junction]], minlength=Nrep)
+                u = np.concatenate([rngs[r].branch.random(arrivals[r]) for r in range(Nrep)])
+                dest[branching] = rep * Nseg + junctions.choose(junction, P, u)
+
+            cells.dest[:] = dest
+        if profiler is not None:
+            moved = np.count_nonzero(dest != cells.seg)
+
+        with stage("swap"):
+            cells.swap()  # Next state becomes current
+
+        # Update conductance, flow and shear stress for all replicas
+        with stage("conductance"):
+            counts = cells.counts.reshape(Nrep, Nseg)
+            D, G, H = conductance(counts)
+        with stage("flow"):
+            P, Q, tau = solve_for_flow_batch(G, Pin, Pout, H, system)
+
+        # Store the output of the simulation
+        with stage("output"):
+            P1 = junctions.branch_probability(counts, tau)
+            for r, i in enumerate(active):
+                if observer is None:
+                    results[i].append(store_output(seeds[i], counts[r], D[r], P1[r], t + 1))
+                else:
+                    observer.update(seeds[i], t + 1, counts[r], D[r], P1[r])
+        if profiler is not None:
+            profiler.end_step(t + 1, len(cells), moved)
+            t_last = t + 1
+
+    if profiler is not None:
+        profiler.end_run(t_last)
+
+    if monitor is not None and len(active):
+        monitor.update(Nt, counts)
+    if observer is not None:
+        for i in active:
+            observer.finish(seeds[i], None if monitor is None else stop_record(monitor.reason[i], monitor.step[i]))
+    elif monitor is not None:
+        for i, ts in enumerate(results):
+            ts[-1].update(stop_record(monitor.reason[i], monitor.step[i]))
+    if checkpoint is not None:
+        remove_checkpoint(checkpoint)
+    return results
@@ -0,0 +1,212 @@
+import json
+import numpy as np
+
+class Network:
+    """Vessel network as a directed graph.
+
+    Nodes have (x, y) positions (m); segment s runs from node start[s] to
+    node end[s], which is the direction of positive flow, and has length
+    length[s] (m, the node distance by default). Pressure is fixed at the
+    inlet and outlet node. Cells leaving the network through one of them
+    re-enter through the other.
+
+    A cell that leaves a segment through its end node moves on into the
+    segments leaving that node (side "out"), one that leaves through its
+    start node into the segments entering it (side "in"). Where there are
+    several such segments the node is a junction. The junctions listed in
+    ``bifurcations`` as (node, side) pairs are decided by the branching
+    rule (all two-way junctions by default); at any other junction cells
+    take the lowest-numbered segment.
+
+    couple_start / couple_end mark which segment ends enter the flow
+    balance of their node (all of them unless given).
+    """
+
+    def __init__(self, nodes, start, end, length=None, inlet=0, outlet=None, bifurcations=None,
+                 couple_start=None, couple_end=None):
+        self.nodes = np.array(nodes, dtype=float).reshape(-1, 2)
+        self.start = np.array(start, dtype=np.intp)
+        self.end = np.array(end, dtype=np.intp)
+        self.Nn = len(self.nodes)
+        self.Nseg = len(self.start)
+        self.inlet = int(inlet)
+        self.outlet = self.Nn - 1 if outlet is None else int(outlet)
+
+        # Unit vector of each segment, from its start to its end node
+        delta = self.nodes[self.end] - self.nodes[self.start]
+        norm = np.hypot(delta[:, 0], delta[:, 1])
+        self.direction = delta / norm[:, None]
+        self.length = norm if length is None else np.array(length, dtype=float)
+
+        self.couple_start = np.ones(self.Nseg, dtype=bool) if couple_start is None else np.array(couple_start, bool)
+        self.couple_end = np.ones(self.Nseg, dtype=bool) if couple_end is None else np.array(couple_end, bool)
+
+        # Segments leaving and entering each node
+        self._out = [[] for _ in range(self.Nn)]
+        self._in = [[] for _ in range(self.Nn)]
+        for seg, (a, b) in enumerate(zip(self.start, self.end)):
+            self._out[a].append(seg)
+            self._in[b].append(seg)
+
+        if bifurcations is None:
+            self.bifurcations = [j for j in self.junctions() if len(j[2]) == 2]
+        else:
+            self.bifurcations = []
+            for node, side in bifurcations:
+                junction = self.transition(node, side)
+                if len(junction[2]) != 2:
+                    raise ValueError(f"Bifurcation at node {node} ({side}) has {len(junction[2])} daughters, "
+                                     f"expected 2")
+                self.bifurcations.append(junction)
+
+    def transition(self, node, side):
+        """(node, side, segments) a cell reaching node can move into, after re-entry at the boundary."""
+        node = int(node)
+        segs = self._out[node] if side == "out" else self._in[node]
+        if not segs and node in (self.inlet, self.outlet):
+            node = self.outlet if node == self.inlet else self.inlet
+            segs = self._out[node] if side == "out" else self._in[node]
+        return node, side, tuple(segs)
+
+    def exits(self, seg):
+        """Transitions of a cell leaving seg through its end and through its start node."""
+        return self.transition(self.end[seg], "out"), self.transition(self.start[seg], "in")
+
+    def junctions(self):
+        """Every transition with more than one segment to choose from."""
+        found = {t for seg in range(self.Nseg) for t in self.exits(seg) if len(t[2]) > 1}
+        return sorted(found)
+
+    def to_dict(self):
+        return {"nodes": self.nodes.tolist(), "segments": np.column_stack((self.start, self.end)).tolist(),
+                "length": self.length.tolist(), "inlet": self.inlet, "outlet": self.outlet,
+                "bifurcations": [[node, side] for node, side, _ in self.bifurcations],
+                "uncoupled_start": np.flatnonzero(~self.couple_start).tolist(),
+                "uncoupled_end": np.flatnonzero(~self.couple_end).tolist()}
+
+
+def branch_daughters(network=None):
+    """Daughter segments of the first bifurcation of network (the default network if None)."""
+    network = DEFAULT_NETWORK if network is None else network
+    if not network.bifurcations:
+        raise ValueError("Network has no bifurcation whose daughter branches could be watched")
+    return list(network.bifurcations[0][2])
+
+
+def network_from_dict(spec):
+    """Build a Network from the dictionary layout used by load_network."""
+    segments = np.array(spec["segments"], dtype=np.intp).reshape(-1, 2)
+    couple_start = np.ones(len(segments), dtype=bool)
+    couple_end = np.ones(len(segments), dtype=bool)
+    couple_start[spec.get("uncoupled_start", [])] = False
+    couple_end[spec.get("uncoupled_end", [])] = False
+    bifurcations = spec.get("bifurcations")
+    return Network(spec["nodes"], segments[:, 0], segments[:, 1], spec.get("length"), spec.get("inlet", 0),
+                   spec.get("outlet"), None if bifurcations is None else [tuple(b) for b in bifurcations],
+                   couple_start, couple_end)
+
+
+def load_network(path):
+    """Read a network from a JSON file.
+
+    Required keys are "nodes" ([[x, y], ...] in m) and "segments"
+    ([[start, end], ...]); optional are "length" (m), "inlet", "outlet",
+    "bifurcations" ([[node, "in" | "out"], ...]) and "uncoupled_start" /
+    "uncoupled_end" (segments left out of a node's flow balance).
+    """
+    with open(path) as f:
+        return network_from_dict(json.load(f))
+
+
+def save_network(network, path):
+    with open(path, "w") as f:
+        json.dump(network.to_dict(), f, indent=1)
+
+
+### Network generators
+
+def default_network(L=None, bifurcations=((15, "in"),)):
+    """The 40-segment network of two parallel vessels used throughout the model.
+
+    Lower vessel: segments 0-19 through nodes 0-20 (up, right, down).
+    Upper vessel: segment 20 leaves node 5, segments 21-38 run through
+    nodes 21-39 and segment 39 rejoins the lower vessel at node 15. Cells
+    moving up segment 15 choose between segments 14 and 39; cells moving
+    up segment 4 take segment 5 unless bifurcations=None, which also
+    enables the junction at node 5 (daughters 5 and 20). As in the
+    original flow equations, the upper vessel is left out of the flow
+    balance at nodes 5 and 15.
+    """
+    L = np.ones(40) * 10e-6 if L is None else np.asarray(L, dtype=float)
+    step = [(0, 1)] * 5 + [(1, 0)] * 10 + [(0, -1)] * 5  # Up, right, down
+    nodes = np.zeros((40, 2))
+    for seg in range(20):  # Lower vessel, from the inlet at the origin
+        nodes[seg + 1] = nodes[seg] + np.multiply(step[seg], L[seg])
+    previous = 5
+    for seg in range(20, 39):  # Upper vessel, from node 5
+        nodes[seg + 1] = nodes[previous] + np.multiply(step[seg - 20], L[seg])
+        previous = seg + 1
+
+    start = np.arange(40)
+    end = np.arange(1, 41)
+    start[20] = 5  # Upper vessel leaves the lower one at node 5
+    end[39] = 15  # ...and rejoins it at node 15
+    couple_start = np.ones(40, dtype=bool)
+    couple_end = np.ones(40, dtype=bool)
+    couple_start[20] = False
+    couple_end[39] = False
+    return Network(nodes, start, end, L, inlet=0, outlet=20, bifurcations=bifurcations,
+                   couple_start=couple_start, couple_end=couple_end)
+
+
+def ladder_network(n, seg_length=10e-6):
+    """Two parallel rails of n segments joined by n + 1 rungs, from the lower left to the upper right corner."""
+    lower = np.arange(n + 1)
+    upper = lower + n + 1
+    nodes = np.concatenate([np.column_stack((lower, np.zeros(n + 1))),
+                            np.column_stack((lower, np.ones(n + 1)))]) * seg_length
+    start = np.concatenate([lower[:-1], upper[:-1], lower])
+    end = np.concatenate([lower[1:], upper[1:], upper])
+    return Network(nodes, start, end, inlet=0, outlet=upper[-1])
+
+
+def tree_network(generations, seg_length=10e-6):
+    """Binary tree splitting `generations` times from the inlet, mirrored to merge back into the outlet."""
+    nodes = [(0.0, 0.0), (seg_length, 0.0)]
+    start, end = [0], [1]
+    frontier = [1]
+    for g in range(generations):  # Diverging half
+        spread = seg_length * 2 ** (generations - g - 1)
+        new = []
+        for node in frontier:
+            x, y = nodes[node]
+            for side in (-1, 1):
+                nodes.append((x + seg_length, y + side * spread))
+                start.append(node)
+                end.append(len(nodes) - 1)
+                new.append(len(nodes) - 1)
+        frontier = new
+    for g in range(generations):  # Converging half
+        new = []
+        for a, b in zip(frontier[0::2], frontier[1::2]):
+            nodes.append((nodes[a][0] + seg_length, (nodes[a][1] + nodes[b][1]) / 2))
+            start += [a, b]
+            end += [len(nodes) - 1] * 2
+            new.append(len(nodes) - 1)
+        frontier = new
+    nodes.append((nodes[frontier[0]][0] + seg_length, 0.0))
+    start.append(frontier[0])
+    end.append(len(nodes) - 1)
+    return Network(nodes, start, end, inlet=0, outlet=len(nodes) - 1)
+
+
+def lattice_network(nx, ny, seg_length=10e-6):
+    """nx by ny grid of nodes with segments pointing right and up, from the lower left to the upper right corner."""
+    index = np.arange(nx * ny).reshape(ny, nx)
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    nodes = np.column_stack((x.ravel(), y.ravel())) * seg_length
+    start = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+    end = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+    return Network(nodes, start, end, inlet=0, outlet=nx * ny - 1)
+
+DEFAULT_NETWORK = default_network()
@@ -0,0 +1,136 @@
+import json
+import numpy as np
+from abm_different_seed_loss_simulation import store_output
+
+# Observers receive the state of every run as the timestep loop goes, instead
+# of run_simulation or run_ensemble keeping the whole time series. Passed as
+# observer=, a sink gets
+#   update(seed, t, Ncell, D, P1)   after the initial state and every step
+#   finish(seed, stop)              once the run is done (stop is the
+#                                   stop_record of a monitored run, else None)
+# and keeps or writes what it is configured to, so memory does not grow with
+# the number of seeds or steps. Several sinks are combined with Tee.
+
+
+class Sink:
+    """Base of the sinks: keeps every ``every``-th step of the selected segments.
+
+    The initial state and the final state of every run (with its stop
+    fields) are always kept. segments=None keeps all segments; otherwise
+    Ncell and D only hold the given segments, whose numbers are stored as
+    "Segments" in each record. Subclasses implement write.
+    """
+
+    def __init__(self, every=1, segments=None):
+        self.every = every
+        self.segments = None if segments is None else np.asarray(segments, dtype=np.intp)
+        self._pending = {}  # seed -> latest (t, Ncell, D, P1), written once the next step shows it is not the last
+
+    def _select(self, values):
+        return np.array(values if self.segments is None else np.asarray(values)[self.segments])
+
+    def update(self, seed, t, Ncell, D, P1):
+        pending = self._pending.get(seed)
+        if pending is not None and pending[0] % self.every == 0:
+            self.write(seed, *pending, None)
+        self._pending[seed] = (t, self._select(Ncell), self._select(D), np.array(P1, dtype=float))
+
+    def finish(self, seed, stop=None):
+        self.write(seed, *self._pending.pop(seed), stop)
+
+    def record(self, seed, t, Ncell, D, P1, stop=None):
+        """store_output record of a kept step."""
+        result = store_output(seed, Ncell, D, P1, t)
+        if self.segments is not None:
+            result["Segments"] = self.segments.tolist()
+        if stop is not None:
+            result.update(stop)
+        return result
+
+    def write(self, seed, t, Ncell, D, P1, stop):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonlSink(Sink):
+    """Appends the kept records to a JSON-lines file as they arrive (readable by stability.analyze_file)."""
+
+    def __init__(self, path, every=1, segments=None, mode="w"):
+        super().__init__(every, segments)
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, seed, t, Ncell, D, P1, stop):
+        self.file.write(json.dumps(self.record(seed, t, Ncell, D, P1, stop), separators=(',', ':')) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class MemorySink(Sink):
+    """Keeps the kept records in ``records``, grouped by seed in ``runs``."""
+
+    def __init__(self, every=1, segments=None):
+        super().__init__(every, segments)
+        self.runs = {}
+
+    def write(self, seed, t, Ncell, D, P1, stop):
+        self.runs.setdefault(seed, []).append(self.record(seed, t, Ncell, D, P1, stop))
+
+    @property
+    def records(self):
+        return [record for run in self.runs.values() for record in run]
+
+
+class SummarySink(Sink):
+    """Reduces the runs to the bifurcation statistics of stability.StabilityStats as they go.
+
+    Only a few numbers per seed and running sums per timestep are kept. The
+    branches are the daughters of the first bifurcation of network (the
+    default network if None) unless given.
+    """
+
+    def __init__(self, every=1, branches=None, network=None):
+        from stability import StabilityStats
+        self.stats = StabilityStats(branches, network)
+        super().__init__(every, self.stats.branches)
+
+    def write(self, seed, t, Ncell, D, P1, stop):
+        self.stats.add_step(seed, t, Ncell, P1.ravel()[0] if P1.size else np.nan)  # P1 of the first junction
+
+    def summary(self, *args, **kwargs):
+        """StabilityStats.summary of the runs so far."""
+        return self.stats.summary(*args, **kwargs)
+
+
+class Tee:
+    """Passes the states on to several sinks."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def update(self, seed, t, Ncell, D, P1):
+        for sink in self.sinks:
+            sink.update(seed, t, Ncell, D, P1)
+
+    def finish(self, seed, stop=None):
+        for sink in self.sinks:
+            sink.finish(seed, stop)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
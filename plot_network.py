@@ -1,50 +1,42 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 
-def plot_network(segments, D, P, Q, seg_cells, tau=None, t=None):  # Add t parameter
-    """Plot the vessel network along with pressure, flow, and cell polarity vectors."""
-    
-    # Constants for time conversion
-    Lseg = 10e-6 # Segment length (m)
-    cellspeed = 3e-6  # Cell speed (m/h)
-    t_time = Lseg / cellspeed  # Time per step in hours
+# Constants for time conversion
+Lseg = 10e-6 # Segment length (m)
+cellspeed = 3e-6  # Cell speed (m/h)
+t_time = Lseg / cellspeed  # Time per step in hours
+
+
+def elapsed_days(t):
+    """Time in days after t steps (0 if t is None)."""
+    return (t * t_time / 24) if t is not None else 0
 
-    # Calculate the current time in hours
-    current_time = (t * t_time / 24) if t is not None else 0
+
+def plot_network(network, D, P, Q, cells, tau=None, t=None):  # Add t parameter
+    """Plot the vessel network (a network.Network) along with pressure, flow, and cell polarity vectors."""
+    import matplotlib.pyplot as plt
+    
+    # Calculate the current time in days
+    current_time = elapsed_days(t)
 
     plt.figure(figsize=(12, 6))
     plt.subplot(1, 2, 1)
     plt.title(f'Pressure, Flow, Diameter of Network\nTime: {current_time:.2f} days')  # Add time to title
 
-    for seg in range(len(segments) - 1):
+    nodes = network.nodes * 1e6  # Node positions (um)
+    for seg in range(network.Nseg):
         if Q[seg] > 0:
             color = "red"
         else:
             color = "blue"
-        
-        # Plot the lower vessel segment
-        plt.plot([segments[seg, 0], segments[seg + 1, 0]], 
-                 [segments[seg, 1], segments[seg + 1, 1]], 
-                 color=color, linewidth=D[seg] * 1e6 / 2)
-        
-        # Calculate the midpoint of the lower vessel segment
-        mid_x_lower = (segments[seg, 0] + segments[seg + 1, 0]) / 2
-        mid_y_lower = (segments[seg, 1] + segments[seg + 1, 1]) / 2
-        
-        # Add the segment number for the lower vessel
-        plt.text(mid_x_lower, mid_y_lower, str(seg), color="black", fontsize=8, ha='center', va='center')
-        
-        # Plot the upper vessel segment
-        plt.plot([segments[seg, 2], segments[seg + 1, 2]], 
-                 [segments[seg, 3], segments[seg + 1, 3]], 
-                 color=color, linewidth=D[seg + len(segments) - 1] * 1e6 / 2)
-        
-        # Calculate the midpoint of the upper vessel segment
-        mid_x_upper = (segments[seg, 2] + segments[seg + 1, 2]) / 2
-        mid_y_upper = (segments[seg, 3] + segments[seg + 1, 3]) / 2
-        
-        # Add the segment number for the upper vessel
-        plt.text(mid_x_upper, mid_y_upper, str(seg + len(segments) - 1), color="black", fontsize=8, ha='center', va='center')
+
+        # Plot the segment between its start and end node
+        a, b = nodes[network.start[seg]], nodes[network.end[seg]]
+        plt.plot([a[0], b[0]], [a[1], b[1]], color=color, linewidth=D[seg] * 1e6 / 2)
+
+        # Add the segment number at its midpoint
+        mid_x, mid_y = (a + b) / 2
+        plt.text(mid_x, mid_y, str(seg), color="black", fontsize=8, ha='center', va='center')
     
     plt.grid()
     
@@ -54,10 +46,139 @@ def plot_network(segments, D, P, Q, seg_cells, tau=None, t=None):  # Add t param
     plt.axis([-1, 1, -1, 1])
     plt.grid()
     
-    print("Segment coordinates:\n", segments)
-    for seg in range(len(seg_cells)):
-        for cell in range(int(seg_cells[seg]['num'])):
-            polarity = seg_cells[seg]['polarity'][cell]
-            plt.plot([0, polarity[0]], [0, polarity[1]], 'b-')
+    print("Node coordinates:\n", network.nodes)
+    for polarity in cells.polarity:
+        plt.plot([0, polarity[0]], [0, polarity[1]], 'b-')
     
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+class NetworkRenderer:
+    """Headless renderer of the frames of a run, for recording movies without a display.
+
+    The figure has the layout of plot_network but is drawn on its own Agg
+    canvas. The axes, grid and labels are rendered once; each draw only
+    updates the segments and the cell polarities (two LineCollections)
+    and the title in place and redraws them over that background.
+    output is a directory to write frame_<t>.png files to, or a video file:
+    .gif (kept in memory until close, so best for short runs) or any
+    format ffmpeg writes, e.g. .mp4. Use as a context manager, or call
+    close() to finish the video.
+    """
+
+    def __init__(self, network, output, fps=10, dpi=100, labels=True):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import LineCollection
+
+        self.output = output
+        self.fps = fps
+        self.figure = Figure(figsize=(12, 6), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+
+        # Segments between their start and end node, with their numbers
+        nodes = network.nodes * 1e6  # Node positions (um)
+        a, b = nodes[network.start], nodes[network.end]
+        self.flow_axes = self.figure.add_subplot(1, 2, 1)
+        self.segments = LineCollection(np.stack([a, b], axis=1), animated=True)
+        self.flow_axes.add_collection(self.segments)
+        self.flow_axes.autoscale_view()
+        self.labels = [self.flow_axes.text(mid_x, mid_y, str(seg), color="black", fontsize=8, ha='center',
+                                           va='center', animated=True)
+                       for seg, (mid_x, mid_y) in enumerate((a + b) / 2)] if labels else []
+        self.flow_axes.grid()
+        self.title = self.flow_axes.set_title("", animated=True)
+
+        # Polarity distribution, one line from the origin per cell
+        self.polarity_axes = self.figure.add_subplot(1, 2, 2)
+        self.polarity_axes.set_title('Distribution of Cell Polarity')
+        self.polarity_axes.axis([-1, 1, -1, 1])
+        self.polarity_axes.grid()
+        self.polarity = LineCollection([], colors='b', linewidths=1, animated=True)
+        self.polarity_axes.add_collection(self.polarity)
+
+        # Render everything that does not change once
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.labels_background = None
+
+        self.frames = []  # GIF frames
+        self.process = None  # ffmpeg
+        if not os.path.splitext(output)[1]:
+            os.makedirs(output, exist_ok=True)
+        elif not output.endswith(".gif"):
+            import subprocess
+            from matplotlib import rcParams
+            width, height = self.canvas.get_width_height()
+            self.process = subprocess.Popen(
+                [rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error', '-f', 'rawvideo',
+                 '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                 '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', output],
+                stdin=subprocess.PIPE)
+
+    def render(self, D, Q, cells, t=None):
+        """Update the artists to this state and redraw them; returns the (height, width, 4) RGBA frame."""
+        self.segments.set_color(np.where(np.asarray(Q) > 0, "red", "blue"))
+        self.segments.set_linewidth(np.asarray(D) * 1e6 / 2)
+        self.title.set_text(f'Pressure, Flow, Diameter of Network\nTime: {elapsed_days(t):.2f} days')
+        lines = np.zeros((len(cells.polarity), 2, 2))
+        lines[:, 1] = cells.polarity  # From the origin to the polarity vector
+        self.polarity.set_segments(lines)
+
+        self.canvas.restore_region(self.background)
+        for artist in [self.segments, self.title, self.polarity]:
+            self.figure.draw_artist(artist)
+        # The segment numbers go on top of the segments; they never change, so
+        # they are drawn once and then copied on top, skipping their background
+        if self.labels:
+            if self.labels_background is None:
+                self._render_labels()
+            self._overlay_labels()
+        return np.asarray(self.canvas.buffer_rgba())
+
+    def _render_labels(self):
+        """Render the segment numbers alone on a transparent frame and keep the pixels they cover."""
+        frame = np.array(self.canvas.buffer_rgba())
+        renderer = self.canvas.get_renderer()
+        renderer.clear()
+        for label in self.labels:
+            self.figure.draw_artist(label)
+        labels = np.asarray(renderer.buffer_rgba())
+        self.labels_background = np.nonzero(labels[:, :, 3])
+        alpha = labels[self.labels_background][:, 3:].astype(np.float32) / 255
+        self.labels_colour = labels[self.labels_background].astype(np.float32) * alpha
+        self.labels_alpha = 1 - alpha
+        labels[:] = frame
+
+    def _overlay_labels(self):
+        buffer = np.asarray(self.canvas.buffer_rgba())
+        covered = buffer[self.labels_background]
+        buffer[self.labels_background] = (self.labels_colour + covered * self.labels_alpha).astype(np.uint8)
+
+    def draw(self, D, P, Q, cells, tau=None, t=None):
+        """Render this state (arguments as plot_network) and write it as the next frame."""
+        frame = self.render(D, Q, cells, t)
+        if self.process is not None:
+            self.process.stdin.write(frame.tobytes())
+        else:
+            from PIL import Image
+            image = Image.fromarray(np.ascontiguousarray(frame[:, :, :3]))  # Opaque, RGB encodes faster
+            if self.output.endswith(".gif"):
+                self.frames.append(image.quantize())
+            else:
+                image.save(os.path.join(self.output, f"frame_{0 if t is None else t:05d}.png"), compress_level=1)
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+        if self.frames:
+            self.frames[0].save(self.output, save_all=True, append_images=self.frames[1:],
+                                duration=int(1000 / self.fps), loop=0)
+            self.frames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
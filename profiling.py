@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import uuid
+import tracemalloc
+from contextlib import nullcontext
+
+# Opt-in instrumentation of the timestep loop. A StageProfiler passed as
+# profiler= to run_simulation or run_ensemble (or in the run_sweep params)
+# records the wall time, calls and, with allocations=True, the memory
+# allocated by every stage of every step. The trace is one JSON row per step
+#   {"pid", "batch", "seed", "replicas", "step", "steps", "cells", "migrations",
+#    "stages": {stage: {"wall": s, "calls": n, "peak_bytes": b, "net_bytes": b}}}
+# (or one row per run with per_step=False), written as JSON lines so the
+# traces of several worker processes can be pooled by aggregate_traces.
+# "batch" identifies the recorded run. A run_ensemble batch is recorded as one
+# run covering "replicas" seeds, starting with "seed", so its rows hold the
+# cost of all of them together; summarize divides by the seeds for per-seed
+# costs. "cells" counts the cells moved through the kernels and "migrations"
+# those that changed segment. "peak_bytes" is the peak memory a stage allocated
+# above what was in use when it started, "net_bytes" what it still holds at
+# its end. tracemalloc only tracks bytes in use, not how many allocations
+# were made, so no allocation counts are recorded.
+
+# Stages of a step: polarity realignment, migration (with the bifurcation
+# choices), swapping the cell buffers, conductance, flow solve and output
+# (branch probability and the stored record, or the plot). run_ensemble
+# also times saving its checkpoint as "checkpoint".
+STAGES = ("realign", "migration", "swap", "conductance", "flow", "output", "checkpoint")
+
+
+class _Stage:
+    """Context manager timing one stage into the profiler's current row."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.allocations:
+            self.memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        stage = self.profiler._row["stages"].setdefault(self.name, dict(wall=0.0, calls=0))
+        stage["wall"] += wall
+        stage["calls"] += 1
+        if self.profiler.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            stage["peak_bytes"] = stage.get("peak_bytes", 0) + peak - self.memory
+            stage["net_bytes"] = stage.get("net_bytes", 0) + current - self.memory
+
+
+class StageProfiler:
+    """Per-stage timing of the timestep loop, per step (or per run with per_step=False) and per seed.
+
+    With trace_dir, flush() appends the rows to trace_<pid>.jsonl there;
+    otherwise they stay in ``rows``. allocations=True also tracks memory
+    with tracemalloc, which slows the run down considerably. A run_ensemble
+    batch is one run whose rows cover all of its ``replicas`` seeds.
+    """
+
+    def __init__(self, trace_dir=None, per_step=True, allocations=False):
+        self.trace_dir = trace_dir
+        self.per_step = per_step
+        self.allocations = allocations
+        self.rows = []
+        self._stages = {}
+        self._row = None
+
+    def stage(self, name):
+        if name not in self._stages:
+            self._stages[name] = _Stage(self, name)
+        return self._stages[name]
+
+    def start_run(self, seed, replicas=1):
+        """Start recording a run (or a batch of replicas starting with seed)."""
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._run = dict(pid=os.getpid(), batch=uuid.uuid4().hex[:16], seed=int(seed), replicas=int(replicas))
+        self._new_row(0)
+
+    def _new_row(self, step):
+        self._row = dict(self._run, step=step, steps=0, cells=0, migrations=0, stages={})
+
+    def end_step(self, step, cells, migrations):
+        """Close step: cells moved through the kernels and how many of them changed segment."""
+        self._row["steps"] += 1
+        self._row["cells"] += int(cells)
+        self._row["migrations"] += int(migrations)
+        if self.per_step:
+            self._row["step"] = step
+            self.rows.append(self._row)
+            self._new_row(step + 1)
+
+    def end_run(self, step):
+        """Close the run after its last step."""
+        if not self.per_step:
+            self._row["step"] = step
+            self.rows.append(self._row)
+        self._row = None
+
+    def flush(self):
+        """Append the recorded rows to this process's trace file (if trace_dir is set) and clear them."""
+        if self.trace_dir is None or not self.rows:
+            return
+        os.makedirs(self.trace_dir, exist_ok=True)
+        with open(os.path.join(self.trace_dir, f"trace_{os.getpid()}.jsonl"), "a") as f:
+            for row in self.rows:
+                f.write(json.dumps(row, separators=(',', ':')) + "\n")
+        self.rows = []
+
+    def summary(self):
+        return summarize(self.rows)
+
+
+def stage_context(profiler):
+    """profiler.stage, or a function returning no-op contexts if profiler is None."""
+    if profiler is None:
+        return lambda name: nullcontext()
+    return profiler.stage
+
+
+def read_trace(path):
+    """Rows of a trace file, or of every trace file in a directory."""
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl"))
+    for trace in paths:
+        with open(trace) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def summarize(rows):
+    """Totals per stage over trace rows, with each stage's share of the time and the throughput.
+
+    Returns {"stages": {stage: {wall, calls, mean, per_seed, share[, peak_bytes, net_bytes]}},
+    "wall", "per_seed", "steps", "cells_per_second", "migrations_per_second", "runs", "seeds",
+    "processes"}. An ensemble batch is one run of "replicas" seeds; per_seed is
+    the wall time divided by the number of seeds.
+    """
+    stages = {}
+    cells = migrations = steps = 0
+    runs, processes = {}, set()
+    for row in rows:
+        for name, stage in row["stages"].items():
+            total = stages.setdefault(name, dict(wall=0.0, calls=0))
+            for key, value in stage.items():
+                total[key] = total.get(key, 0) + value
+        cells += row["cells"]
+        migrations += row["migrations"]
+        steps += row["steps"]
+        runs[row.get("batch", (row["pid"], row["seed"]))] = row["replicas"]
+        processes.add(row["pid"])
+    wall = sum(stage["wall"] for stage in stages.values())
+    seeds = sum(runs.values())
+    for stage in stages.values():
+        stage["mean"] = stage["wall"] / stage["calls"] if stage["calls"] else 0.0
+        stage["per_seed"] = stage["wall"] / seeds if seeds else 0.0
+        stage["share"] = stage["wall"] / wall if wall else 0.0
+    return dict(stages=stages, wall=wall, per_seed=wall / seeds if seeds else 0.0, steps=steps, runs=len(runs),
+                seeds=seeds, processes=len(processes),
+                cells_per_second=cells / wall if wall else 0.0,
+                migrations_per_second=migrations / wall if wall else 0.0)
+
+
+def aggregate_traces(path):
+    """summarize over the trace files that the workers of a sweep wrote to path."""
+    return summarize(read_trace(path))
+
+
+def print_summary(summary):
+    print(f"{summary['wall']:.3f} s in {summary['runs']} runs of {summary['seeds']} seeds on "
+          f"{summary['processes']} processes, {summary['per_seed'] * 1e3:.2f} ms/seed, "
+          f"{summary['cells_per_second']:.3g} cells/s, {summary['migrations_per_second']:.3g} migrations/s")
+    for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["wall"]):
+        alloc = f", {stage['peak_bytes'] / 1e6:.1f} MB allocated" if "peak_bytes" in stage else ""
+        print(f"  {name:<12} {stage['wall']:9.3f} s {100 * stage['share']:5.1f}% "
+              f"{stage['calls']:8d} calls {stage['mean'] * 1e6:9.1f} us/call "
+              f"{stage['per_seed'] * 1e3:8.2f} ms/seed{alloc}")
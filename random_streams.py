@@ -0,0 +1,45 @@
+import numpy as np
+
+# Random parts of a run, each with its own stream
+#   init       initial cell polarities
+#   polarity   random walk vectors of the polarity realignment (w4)
+#   migration  migration chance draws (MCHANCE < 1)
+#   branch     decisions of the cells arriving at a stochastic bifurcation
+STREAMS = ("init", "polarity", "migration", "branch")
+
+
+class RandomStreams:
+    """Independent np.random.Generator streams of one simulation, spawned from its seed.
+
+    Because every random part draws from its own stream, a run's numbers do
+    not depend on which other parts draw (e.g. whether w4 is 0) or on how
+    runs are grouped into batches and workers. With legacy=True all parts
+    share one RandomState(seed) instead, which reproduces results made with
+    np.random.seed(seed) before the streams were introduced.
+    """
+
+    def __init__(self, seed, legacy=False):
+        self.seed = int(seed)
+        self.legacy = legacy
+        if legacy:
+            shared = np.random.RandomState(self.seed)
+            for name in STREAMS:
+                setattr(self, name, shared)
+        else:
+            children = np.random.SeedSequence(self.seed).spawn(len(STREAMS))
+            for name, child in zip(STREAMS, children):
+                setattr(self, name, np.random.Generator(np.random.PCG64(child)))
+
+    def get_state(self):
+        """Bit generator state of every stream, e.g. for a checkpoint."""
+        if self.legacy:
+            return {"legacy": self.init.get_state(legacy=False)}
+        return {name: getattr(self, name).bit_generator.state for name in STREAMS}
+
+    def set_state(self, state):
+        """Restore a state returned by get_state."""
+        if self.legacy:
+            self.init.set_state(state["legacy"])
+        else:
+            for name in STREAMS:
+                getattr(self, name).bit_generator.state = state[name]
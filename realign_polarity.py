@@ -1,51 +1,76 @@
 import numpy as np
+from network import DEFAULT_NETWORK
 
-def realign_polarity(seg, Q, seg_cells, new_seg_cells, w1, w2, w3, w4):
-    """Realign the polarity vectors of all cells in a segment based on weight factors."""
-    
-    if seg_cells[seg]['num'] != 0:
-
-        ### Neighbor alignment component
-        neighbor_vect = np.mean(seg_cells[seg]['polarity'], axis=0)
-        neighbor_vect /= np.linalg.norm(neighbor_vect)
-
-        for cell in range(int(seg_cells[seg]['num'])):
-            # Persistence alignment component
-            polar_vect = seg_cells[seg]['polarity'][cell]
-            
-            # Guarantees that flow_vect always has a value, even if seg falls outside the expected ranges
-            flow_vect = np.array([0, 0])  # Default to zero vector
-            
-            ### Flow alignment component
-            if 0 <= seg <= 4 or 20 <= seg <= 24:
-                flow_vect = -np.array([0, 1]) * np.sign(Q[seg])
-            elif 5 <= seg <= 14 or 25 <= seg <= 34:
-                flow_vect = -np.array([1, 0]) * np.sign(Q[seg])
-            elif 15 <= seg <= 19 or 35 <= seg <= 39:
-                flow_vect = -np.array([0, -1]) * np.sign(Q[seg])
-            
-            # Random walk alignment component
-            rand_walk_vect = np.random.randn(2)
-            rand_walk_vect /= np.linalg.norm(rand_walk_vect)
-
-            
-            # Calculate alignment angles
-            phi2 = np.arccos(np.clip(np.dot(flow_vect, polar_vect), -1, 1))
-            phi4 = np.arccos(np.clip(np.dot(rand_walk_vect, polar_vect), -1, 1))
-            ### phi3
-            phi3 = np.arccos(np.clip(np.dot(neighbor_vect, polar_vect), -1, 1))
-            
-
-
-            # Determine rotation direction
-            ### add phi3
-            theta = w1 * 0 + w2 * phi2 + w3 * phi3 + w4 * phi4
-            rotation_matrix = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-            new_polar_vect = np.dot(rotation_matrix, polar_vect)
-            new_polar_vect /= np.linalg.norm(new_polar_vect)
-            
-            # Assign the updated polarity vector
-            seg_cells[seg]['polarity'][cell] = new_polar_vect
-            new_seg_cells[seg]['polarity'][cell] = new_polar_vect
-    
-    return seg_cells, new_seg_cells
+def segment_axis(network=None):
+    """Unit vector of each segment, pointing from its upstream to its downstream node."""
+    return (network or DEFAULT_NETWORK).direction
+
+_SEGMENT_AXIS = segment_axis()
+
+
+def flow_direction(Q, axis=None):
+    """Per-segment flow alignment vector: cells polarize against the flow."""
+    if axis is None:
+        axis = _SEGMENT_AXIS
+    return -axis * np.sign(Q)[:, None]
+
+
+def _unit(vect):
+    """Normalize the rows of an (N, 2) array in place."""
+    vect /= np.sqrt(vect[:, 0] * vect[:, 0] + vect[:, 1] * vect[:, 1])[:, None]
+    return vect
+
+
+def _angle(vect, polar):
+    """Angle between matching rows of two (N, 2) arrays of unit vectors."""
+    return np.arccos(np.clip(vect[:, 0] * polar[:, 0] + vect[:, 1] * polar[:, 1], -1, 1))
+
+
+def realign_polarity(Q, cells, w1, w2, w3, w4, axis=None, noise=None, rng=None):
+    """Realign the polarity vectors of all cells in the network based on weight factors.
+
+    Each cell is rotated by theta = w2 * phi2 + w3 * phi3 + w4 * phi4, where
+    phi2, phi3 and phi4 are its angles to the flow direction, the mean
+    polarity of its segment and a random unit vector (persistence, w1,
+    contributes no rotation). Terms with zero weight are skipped, so the
+    random vectors are only drawn when w4 != 0, from rng (an
+    np.random.Generator or RandomState, the global stream if None).
+    ``noise`` may pass in pre-drawn (Ncells, 2) Gaussian vectors instead.
+    """
+    if len(cells) == 0:
+        return cells
+
+    polar = cells.polarity
+    theta = np.zeros(len(cells))
+
+    ### Flow alignment component
+    if w2 != 0:
+        flow_vect = flow_direction(Q, axis)[cells.seg]
+        theta += w2 * _angle(flow_vect, polar)
+
+    ### Neighbor alignment component
+    if w3 != 0:
+        neighbor_vect = np.empty((cells.Nseg, 2))
+        neighbor_vect[:, 0] = np.bincount(cells.seg, weights=polar[:, 0], minlength=cells.Nseg)
+        neighbor_vect[:, 1] = np.bincount(cells.seg, weights=polar[:, 1], minlength=cells.Nseg)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _unit(neighbor_vect)
+        theta += w3 * _angle(neighbor_vect[cells.seg], polar)
+
+    # Random walk alignment component
+    if w4 != 0:
+        if noise is None:
+            rand_walk_vect = (np.random if rng is None else rng).standard_normal((len(cells), 2))
+        else:
+            rand_walk_vect = np.array(noise, dtype=float)
+        theta += w4 * _angle(_unit(rand_walk_vect), polar)
+
+    # Rotate every cell by its angle and renormalize
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+    x = polar[:, 0].copy()
+    polar[:, 0] = cos_theta * x - sin_theta * polar[:, 1]
+    polar[:, 1] = sin_theta * x + cos_theta * polar[:, 1]
+    _unit(polar)
+
+    return cells
@@ -0,0 +1,177 @@
+import os
+import json
+import types
+import zipfile
+import hashlib
+import numpy as np
+from network import DEFAULT_NETWORK
+from results_io import pack_results, unpack_results, save_results, load_results
+
+# Bump whenever a change to the model alters the results of existing parameters,
+# so entries computed by the old model are no longer found
+MODEL_VERSION = "1"
+
+
+def _canonical(value):
+    """JSON-able form of a parameter value that is equal for equal parameters."""
+    if isinstance(value, (bool, np.bool_)) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)  # Pin=100 and Pin=100.0 run the same simulation
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if hasattr(value, "to_dict"):  # network.Network, convergence.ConvergenceMonitor
+        return _canonical(value.to_dict())
+    if callable(value) and hasattr(value, "__qualname__"):
+        name = f"{value.__module__}.{value.__qualname__}"
+        if not hasattr(value, "__code__"):  # Built-in functions and classes
+            return name
+        # The name alone is shared by every lambda and by redefinitions, so the
+        # code, defaults and closed-over values identify the function
+        return {"function": name, "code": _code_hash(value.__code__),
+                "defaults": _canonical(list(value.__defaults__ or ())),
+                "closure": _canonical([cell.cell_contents for cell in value.__closure__ or ()])}
+    # Other objects, e.g. a BranchRule instance: class and attributes
+    settings = {k: v for k, v in vars(value).items() if not k.startswith("_")}
+    return {"class": f"{type(value).__module__}.{type(value).__qualname__}", **_canonical(settings)}
+
+
+def _code_hash(code):
+    """Hash of a code object's bytecode, constants and names, including those of nested functions."""
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = _code_hash(const)
+        elif isinstance(const, frozenset):  # Set order depends on the process's string hashing
+            const = sorted(map(repr, const))
+        digest.update(repr(const).encode())
+    digest.update(repr(code.co_names).encode())
+    return digest.hexdigest()
+
+
+def _resolve_rules(branch_rule):
+    """The BranchRule objects behind branch rule keys, so a key re-registered to another rule gives another hash."""
+    from cell_migration import get_branch_rule
+    if isinstance(branch_rule, dict):
+        return {k: _resolve_rules(v) for k, v in branch_rule.items()}
+    if isinstance(branch_rule, (list, tuple, np.ndarray)):  # One rule per junction
+        return [get_branch_rule(key) for key in branch_rule]
+    return get_branch_rule(branch_rule)
+
+
+def parameter_key(seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha, w1, w2, w3, w4, L,
+                  incremental_flow=False, monitor=None, network=None, legacy_rng=False, version=MODEL_VERSION):
+    """Content hash of every run_simulation parameter and the model version.
+
+    Branch rules are hashed by the rule registered under their key (its class,
+    settings and function code), not by the key.
+    """
+    params = dict(seed=seed, Nt=Nt, Pin=Pin, Pout=Pout, mu=mu, Nseg=Nseg, num_cell=num_cell, cell_size=cell_size,
+                  branch_rule=_resolve_rules(branch_rule), branch_alpha=branch_alpha, w1=w1, w2=w2, w3=w3, w4=w4, L=L,
+                  incremental_flow=incremental_flow, monitor=monitor, network=network or DEFAULT_NETWORK,
+                  legacy_rng=legacy_rng, version=version)
+    text = json.dumps(_canonical(params), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    """On-disk cache of run_simulation time series, addressed by parameter_key.
+
+    Each entry is one compressed .npz (see results_io) named by its key.
+    Reading an entry marks it as recently used; once the cache grows beyond
+    max_bytes the least recently used entries are removed. Entries are
+    written atomically, so several processes may share a cache directory.
+    """
+
+    def __init__(self, directory, max_bytes=None, version=MODEL_VERSION):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, seed, *args, **kwargs):
+        return parameter_key(seed, *args, version=self.version, **kwargs)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Cached time series of key, or None."""
+        path = self._path(key)
+        try:
+            results = load_results(path)
+            os.utime(path)  # Most recently used
+        except FileNotFoundError:  # Missing, or evicted meanwhile
+            self.misses += 1
+            return None
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):  # Truncated or corrupt entry
+            self.misses += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        self.hits += 1
+        return unpack_results(results)[0]
+
+    def put(self, key, time_series):
+        """Store the time series of one run under key and evict down to max_bytes."""
+        tmp = os.path.join(self.directory, f".{key}.{os.getpid()}.tmp.npz")
+        save_results(tmp, pack_results([time_series]))
+        os.replace(tmp, self._path(key))
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def entries(self):
+        """(last use, size, path) of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and not name.startswith("."):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes):
+        """Remove least recently used entries until the cache holds at most max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+    def run_simulation(self, seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha,
+                       w1, w2, w3, w4, L, incremental_flow=False, monitor=None, network=None, legacy_rng=False):
+        """run_simulation, returning the cached time series when these parameters have been run before."""
+        from abm_different_seed_loss_simulation import run_simulation
+        from random_streams import RandomStreams
+        args = (seed, Nt, Pin, Pout, mu, Nseg, num_cell, cell_size, branch_rule, branch_alpha, w1, w2, w3, w4, L)
+        key = self.key(*args, incremental_flow=incremental_flow, monitor=monitor, network=network,
+                       legacy_rng=legacy_rng)
+        time_series = self.get(key)
+        if time_series is None:
+            time_series = run_simulation(*args, incremental_flow, monitor, network,
+                                         RandomStreams(seed, legacy_rng))
+            self.put(key, time_series)
+        return time_series
@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# Columnar result layout: one row per seed, one column per stored timestep
+#   seed  (Nseed,)             random seed of each row
+#   Ncell (Nseed, Nt+1, Nseg)  cells per segment
+#   D     (Nseed, Nt+1, Nseg)  segment diameters (m)
+#   P1    (Nseed, Nt+1)        probability of choosing branch 15 (first daughter of the first junction)
+#   P1_junctions (Nseed, Nt+1, Nj)  the same for every junction, for networks with several
+# stored either as a directory of .npy files (memory-mappable, writable in
+# place) or as one compressed .npz archive, with the run parameters as JSON.
+# Runs stopped early by a ConvergenceMonitor also carry
+#   stop_step   (Nseed,)  step the run stopped at (-1 if it ran to the end)
+#   stop_reason (Nseed,)  why it stopped ("" if it ran to the end)
+FIELDS = ("seed", "Ncell", "D", "P1")
+OPTIONAL_FIELDS = ("P1_junctions", "stop_step", "stop_reason")
+DTYPES = dict(seed=np.int64, Ncell=np.int32, D=float, P1=float, P1_junctions=float, stop_step=np.int64,
+              stop_reason="<U11")
+
+
+def pack_results(time_series):
+    """Convert a list of per-seed store_output time series into a dict of dense arrays."""
+    results = dict(seed=[ts[0]["Random Seed"] for ts in time_series],
+                   Ncell=[[r["Ncell"] for r in ts] for ts in time_series],
+                   D=[[r["D"] for r in ts] for ts in time_series],
+                   P1=[[r["P1"] for r in ts] for ts in time_series])
+    if time_series and "P1 Junctions" in time_series[0][0]:
+        results["P1_junctions"] = [[r["P1 Junctions"] for r in ts] for ts in time_series]
+    if time_series and "Stop Reason" in time_series[0][-1]:
+        results["stop_step"] = [ts[-1]["Stop Step"] if ts[-1]["Stop Step"] is not None else -1
+                                for ts in time_series]
+        results["stop_reason"] = [ts[-1]["Stop Reason"] or "" for ts in time_series]
+    return {name: np.asarray(value, dtype=DTYPES[name]) for name, value in results.items()}
+
+
+def unpack_results(results):
+    """Inverse of pack_results: per-seed lists of store_output dictionaries."""
+    Ncell, D, P1 = results["Ncell"], results["D"], results["P1"]
+    time_series = [[{"Random Seed": int(seed), "Time Step": t, "Ncell": Ncell[i, t].tolist(),
+                     "D": D[i, t].tolist(), "P1": float(P1[i, t])} for t in range(Ncell.shape[1])]
+                   for i, seed in enumerate(results["seed"])]
+    if "P1_junctions" in results:
+        for i, ts in enumerate(time_series):
+            for t, record in enumerate(ts):
+                record["P1 Junctions"] = results["P1_junctions"][i, t].tolist()
+    if "stop_step" in results:
+        for ts, step, reason in zip(time_series, results["stop_step"], results["stop_reason"]):
+            ts[-1].update({"Stop Reason": str(reason) or None, "Stop Step": int(step) if step >= 0 else None})
+    return time_series
+
+
+def save_results(path, results, metadata=None):
+    """Write a dict of result arrays as a compressed .npz archive, or as a .npy directory for any other path."""
+    arrays = {name: np.asarray(results[name], dtype=DTYPES[name])
+              for name in FIELDS + OPTIONAL_FIELDS if name in results}
+    if path.endswith(".npz"):
+        np.savez_compressed(path, metadata=np.array(json.dumps(metadata or {})), **arrays)
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata or {}, f)
+
+
+def load_results(path, mmap=True):
+    """Load results as a dict of arrays plus 'metadata'.
+
+    A .npy directory is memory-mapped read-only unless mmap is False; an
+    .npz archive is decompressed into memory as a whole (stability.iter_arrays
+    reads one in blocks of seeds instead).
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as archive:
+            results = {name: archive[name] for name in FIELDS + OPTIONAL_FIELDS if name in archive.files}
+            results["metadata"] = json.loads(str(archive["metadata"]))
+        return results
+    results = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+               for name in FIELDS + OPTIONAL_FIELDS if os.path.exists(os.path.join(path, name + ".npy"))}
+    with open(os.path.join(path, "metadata.json")) as f:
+        results["metadata"] = json.load(f)
+    return results
+
+
+def compress_results(directory, path, remove=True):
+    """Pack a .npy result directory into a compressed .npz archive."""
+    results = load_results(directory)
+    save_results(path, results, metadata=results.pop("metadata"))
+    if remove:
+        shutil.rmtree(directory)
+
+
+class ResultWriter:
+    """Preallocated on-disk .npy result directory that chunks of seeds are written into.
+
+    Rows are addressed by seed, so chunks may arrive in any order and only
+    the chunk being written is held in memory. With stop=True the early
+    termination fields are stored as well, and with Nj > 1 the P1 of every
+    junction. resume=True reopens an existing directory to fill in the
+    remaining rows.
+    """
+
+    def __init__(self, path, seeds, Nt, Nseg, metadata=None, stop=False, Nj=1, resume=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.row = {int(seed): i for i, seed in enumerate(seeds)}
+        Nseed = len(seeds)
+        shapes = dict(seed=(Nseed,), Ncell=(Nseed, Nt + 1, Nseg), D=(Nseed, Nt + 1, Nseg), P1=(Nseed, Nt + 1))
+        if stop:
+            shapes.update(stop_step=(Nseed,), stop_reason=(Nseed,))
+        if Nj > 1:
+            shapes.update(P1_junctions=(Nseed, Nt + 1, Nj))
+        if resume:
+            self.arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="r+")
+                           for name in shapes}
+            return
+        self.arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+",
+                                                       dtype=DTYPES[name], shape=shape)
+                       for name, shape in shapes.items()}
+        self.arrays["seed"][:] = seeds
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata or {}, f)
+
+    def write(self, results):
+        """Store a dict of packed result arrays in the rows of its seeds."""
+        rows = [self.row[int(seed)] for seed in results["seed"]]
+        for name, array in self.arrays.items():
+            if name != "seed":
+                array[rows] = results[name]
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        self.flush()
+        self.arrays = {}
+
+
+def read_json_results(json_path):
+    """Read store_output records from a JSON list or a JSON-lines file, grouped per seed."""
+    with open(json_path) as f:
+        if json_path.endswith(".jsonl"):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = json.load(f)
+        time_series = {}
+        for record in records:
+            time_series.setdefault(record["Random Seed"], []).append(record)
+    for ts in time_series.values():
+        ts.sort(key=lambda r: r["Time Step"])
+    return list(time_series.values())
+
+
+def convert_json(json_path, out_path, metadata=None):
+    """Convert an existing JSON (or JSON-lines) result file to the binary format."""
+    save_results(out_path, pack_results(read_json_results(json_path)), metadata=metadata)
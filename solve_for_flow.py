@@ -1,56 +1,286 @@
+import functools
 import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import spsolve, splu
+from network import DEFAULT_NETWORK
 
-def solve_for_flow(G, Pin, Pout, H=None):
+def build_incidence(network=None):
+    """Segment-node incidence of a vessel network (the default network if None).
+
+    Returns the start and end node of every segment (flow is positive from
+    start to end), the inlet and outlet nodes, and whether each segment
+    enters the flow balance of its start and end node.
+    """
+    if network is None:
+        network = DEFAULT_NETWORK
+    return (network.start, network.end, network.inlet, network.outlet,
+            network.couple_start, network.couple_end)
+
+
+class FlowSystem:
+    """Sparse conductance Laplacian of a network with fixed inlet/outlet pressure.
+
+    The sparsity pattern is built once from the incidence; assembling the
+    system for new conductances is a pair of bincounts.
+    """
+
+    def __init__(self, start, end, inlet, outlet, couple_start=None, couple_end=None, Nn=None):
+        self.start = np.asarray(start, dtype=np.intp)
+        self.end = np.asarray(end, dtype=np.intp)
+        self.Nseg = len(self.start)
+        self.Nn = int(max(self.start.max(), self.end.max()) + 1) if Nn is None else Nn
+        self.boundary = np.array([inlet, outlet], dtype=np.intp)
+
+        # Reduced index of each node (-1 for the fixed-pressure boundary nodes)
+        self.interior = np.setdiff1d(np.arange(self.Nn), self.boundary)
+        self.ridx = np.full(self.Nn, -1, dtype=np.intp)
+        self.ridx[self.interior] = np.arange(len(self.interior))
+        rs, re = self.ridx[self.start], self.ridx[self.end]
+
+        # Drop the rows of segment ends left out of their node's flow balance
+        rs_row = rs if couple_start is None else np.where(couple_start, rs, -1)
+        re_row = re if couple_end is None else np.where(couple_end, re, -1)
+
+        # Laplacian entries as (row, col, sign); each segment adds +G on the
+        # diagonal and -G off the diagonal of the rows of both its nodes
+        entries = [(rs_row, rs, 1), (re_row, re, 1), (rs_row, re, -1), (re_row, rs, -1)]
+        rows = np.concatenate([r for r, c, s in entries])
+        cols = np.concatenate([c for r, c, s in entries])
+        segs = np.tile(np.arange(self.Nseg), len(entries))
+        signs = np.repeat([s for r, c, s in entries], self.Nseg).astype(float)
+        keep = (rows >= 0) & (cols >= 0)
+
+        # Map every entry onto its slot in the CSR data array
+        n = len(self.interior)
+        keys, self._slot = np.unique(rows[keep] * n + cols[keep], return_inverse=True)
+        self._segs = segs[keep]
+        self._signs = signs[keep]
+        self.indices = keys % n
+        self.indptr = np.searchsorted(keys // n, np.arange(n + 1))
+        self.nnz = len(keys)
+
+        # Segments connecting an interior node to a boundary node feed the right-hand side
+        self._rhs_start = np.flatnonzero((rs_row >= 0) & (re < 0))  # Interior start, boundary end
+        self._rhs_end = np.flatnonzero((rs < 0) & (re_row >= 0))  # Boundary start, interior end
+
+        # Dense scatter of the entries and boundary terms for stacked (batched) assembly
+        self._dense_scatter = sp.csr_matrix(
+            (np.ones(len(self._slot)), (rows[keep] * n + cols[keep], np.arange(len(self._slot)))),
+            shape=(n * n, len(self._slot)))
+        self._rhs_scatter = [
+            sp.csr_matrix((np.ones(len(s)), (node, np.arange(len(s)))), shape=(n, len(s)))
+            for s, node in ((self._rhs_start, rs[self._rhs_start]), (self._rhs_end, re[self._rhs_end]))]
+
+        # Each segment adds G * u v^T to C, with u over the rows it enters and v = e_start - e_end
+        self._u = (rs_row, re_row)
+        self._v = (rs, re)
+
+    def segment_vectors(self, segs):
+        """Dense (n, k) factors U, V with C = sum over segments of G * u v^T."""
+        n = len(self.interior)
+        U = np.zeros((n + 1, len(segs)))  # Extra row absorbs the boundary index -1
+        V = np.zeros((n + 1, len(segs)))
+        cols = np.arange(len(segs))
+        for A, (first, second) in ((U, self._u), (V, self._v)):
+            A[first[segs], cols] += 1
+            A[second[segs], cols] -= 1
+        return U[:n], V[:n]
+
+    def assemble(self, G, P_boundary):
+        """Assemble the reduced system C x = B for the interior node pressures."""
+        n = len(self.interior)
+        data = np.bincount(self._slot, weights=G[self._segs] * self._signs, minlength=self.nnz)
+        C = sp.csr_matrix((data, self.indices, self.indptr), shape=(n, n))
+
+        P_node = np.zeros(self.Nn)
+        P_node[self.boundary] = P_boundary
+        s, e = self._rhs_start, self._rhs_end
+        B = np.bincount(self.ridx[self.start[s]], weights=G[s] * P_node[self.end[s]], minlength=n)
+        B += np.bincount(self.ridx[self.end[e]], weights=G[e] * P_node[self.start[e]], minlength=n)
+        return C, B
+
+    def assemble_batch(self, G, P_boundary):
+        """Assemble dense stacked systems for conductances G of shape (Nrep, Nseg).
+
+        Entries are summed in the same order as in assemble, so each system
+        is bit-identical to the dense form of the unbatched one.
+        """
+        n = len(self.interior)
+        Nrep = len(G)
+        C = (self._dense_scatter @ (G[:, self._segs] * self._signs).T).T.reshape(Nrep, n, n)
+
+        P_node = np.zeros(self.Nn)
+        P_node[self.boundary] = P_boundary
+        s, e = self._rhs_start, self._rhs_end
+        B = (self._rhs_scatter[0] @ (G[:, s] * P_node[self.end[s]]).T).T
+        B += (self._rhs_scatter[1] @ (G[:, e] * P_node[self.start[e]]).T).T
+        return C, B
+
+    def pressures(self, x, P_boundary):
+        """Full nodal pressure array from the interior solution (leading axes allowed)."""
+        P = np.zeros(x.shape[:-1] + (self.Nn,))
+        P[..., self.boundary] = P_boundary
+        P[..., self.interior] = x
+        return P
+
+    def flows(self, G, P):
+        """Segment flow from start to end node."""
+        return G * (P[..., self.start] - P[..., self.end])
+
+
+@functools.lru_cache(maxsize=16)
+def flow_system(network=None):
+    """FlowSystem of a network, built once per network."""
+    return FlowSystem(*build_incidence(network), Nn=(network or DEFAULT_NETWORK).Nn)
+
+_FLOW_SYSTEM = flow_system()
+
+DENSE_MAX = 100  # Below this many interior nodes a dense solve beats the sparse one
+
+
+def solve_for_flow(G, Pin, Pout, H=None, system=None):
     """Solve for flow in the bifurcating vessel network."""
-    Nn = 40  # Number of nodes
-    Nseg = 40  # Number of segments
+    if system is None:
+        system = _FLOW_SYSTEM
 
     # Set very small values for zero conductance to avoid singular matrix errors
     G[G == 0] = 1e-25
-    
-    # Initialize matrices
-    P = np.zeros(Nn)  # Nodal pressure array (Pa)
-    Q = np.zeros(Nseg)  # Segment flow array (m^3/s)
-    C = np.zeros((Nn, Nn))  # Conductance matrix
-    B = np.zeros(Nn)  # Solution vector
-    
-    
-    # Set equations for internal nodes
-    for seg in range(Nn):
-        if seg == 0:
-            C[seg, seg] = G[0] * 1
-            B[seg] = G[0] * Pin
-        if 1 <= seg <= 19 or 22 <= seg <= 38:
-            C[seg, seg - 1] = -G[seg - 1]
-            C[seg, seg] = G[seg - 1] + G[seg]
-            C[seg, seg + 1] = -G[seg]
-        if seg == 20:
-        # Set equation for last node
-            C[20, 20] = G[19] * 1
-            B[20] = G[19] * Pout
-        if seg == 21:
-            C[21, 5] = -G[20]
-            C[21, 21] = G[20] + G[21]
-            C[21, 22] = -G[21]
-        if seg == 39:
-            C[39, 38] = -G[38]
-            C[39, 39] = G[38] + G[39]
-            C[39, 15] = -G[39]
-    
+
     # Solve for pressure
-    P = np.linalg.solve(C, B)
-    
-    for seg in range(Nseg):
-        if seg <= 19 or 21 <= seg <= 38:  # Prevent out-of-bounds access
-            Q[seg] = -G[seg] * (P[seg + 1] - P[seg])
-        elif seg == 20:
-            Q[seg] = -G[seg] * (P[seg + 1] - P[5])
-        elif seg == 39:
-            Q[seg] = -G[seg] * (P[15] - P[seg])
-        
+    C, B = system.assemble(G, (Pin, Pout))
+    if C.shape[0] <= DENSE_MAX:
+        x = np.linalg.solve(C.toarray(), B)
+    else:
+        x = spsolve(C.tocsc(), B)
+    P = system.pressures(x, (Pin, Pout))
+    Q = system.flows(G, P)
+
     # Compute shear stress if H is provided
     if H is not None:
         tau = H * Q
         return P, Q, tau
     else:
-        return P, Q
\ No newline at end of file
+        return P, Q
+
+
+def solve_for_flow_batch(G, Pin, Pout, H=None, system=None):
+    """Solve for flow in many replicas of the network with one stacked dense solve.
+
+    G (and H) have shape (Nrep, Nseg); P, Q and tau gain the same leading
+    axis. For networks solved densely by solve_for_flow the results are
+    bit-identical to solving each replica on its own; larger networks are
+    solved one sparse system per replica.
+    """
+    if system is None:
+        system = _FLOW_SYSTEM
+
+    # Set very small values for zero conductance to avoid singular matrix errors
+    G[G == 0] = 1e-25
+
+    if len(system.interior) > DENSE_MAX:
+        x = np.empty((len(G), len(system.interior)))
+        for r in range(len(G)):
+            C, B = system.assemble(G[r], (Pin, Pout))
+            x[r] = spsolve(C.tocsc(), B)
+    else:
+        C, B = system.assemble_batch(G, (Pin, Pout))
+        x = np.linalg.solve(C, B[..., None])[..., 0]
+    P = system.pressures(x, (Pin, Pout))
+    Q = system.flows(G, P)
+
+    # Compute shear stress if H is provided
+    if H is not None:
+        tau = H * Q
+        return P, Q, tau
+    else:
+        return P, Q
+
+
+def _factorize(C):
+    """LU-factorize C and return a function solving C x = b."""
+    if C.shape[0] <= DENSE_MAX:
+        lu = lu_factor(C.toarray())
+        return lambda b: lu_solve(lu, b)
+    return splu(C.tocsc()).solve
+
+
+class IncrementalFlowSolver:
+    """Flow solver that keeps a factorization of the conductance system.
+
+    When only a few conductances differ from the factorized ones, the new
+    system is solved with a Woodbury low-rank update instead of a refactor;
+    past max_rank changed segments it refactors. Every solution is checked
+    through its residual and recomputed from a fresh factorization if the
+    relative residual exceeds rtol. With check_every > 0, every n-th solve
+    is also compared with a full solve_for_flow and the worst relative
+    pressure error is kept in max_error.
+    """
+
+    def __init__(self, system=None, max_rank=8, rtol=1e-10, check_every=0):
+        self.system = _FLOW_SYSTEM if system is None else system
+        self.max_rank = max_rank
+        self.rtol = rtol
+        self.check_every = check_every
+        self.stats = {'refactor': 0, 'update': 0, 'fallback': 0}
+        self.max_error = 0.0
+        self._G0 = None
+        self._solve0 = None
+        self._n_solves = 0
+
+    def _refactor(self, G, C):
+        self._G0 = G.copy()
+        self._solve0 = _factorize(C)
+        self.stats['refactor'] += 1
+
+    def _update(self, G, B, changed):
+        """Solve (C0 + U diag(dG) V^T) x = B with the Woodbury identity."""
+        U, V = self.system.segment_vectors(changed)
+        dG = G[changed] - self._G0[changed]
+        y = self._solve0(B)
+        Z = self._solve0(U)
+        capacitance = np.diag(1 / dG) + V.T @ Z
+        self.stats['update'] += 1
+        return y - Z @ np.linalg.solve(capacitance, V.T @ y)
+
+    def solve(self, G, Pin, Pout, H=None):
+        """Same contract as solve_for_flow."""
+        system = self.system
+
+        # Set very small values for zero conductance to avoid singular matrix errors
+        G[G == 0] = 1e-25
+
+        C, B = system.assemble(G, (Pin, Pout))
+        changed = np.flatnonzero(G != self._G0) if self._G0 is not None else None
+        if changed is None or len(changed) > self.max_rank:
+            self._refactor(G, C)
+            changed = changed[:0] if changed is not None else np.zeros(0, dtype=np.intp)
+
+        if len(changed) == 0:
+            x = self._solve0(B)
+        else:
+            x = self._update(G, B, changed)
+            # Fall back to a full refactor if the update lost accuracy
+            if np.linalg.norm(C @ x - B) > self.rtol * np.linalg.norm(B):
+                self.stats['fallback'] += 1
+                self._refactor(G, C)
+                x = self._solve0(B)
+
+        P = system.pressures(x, (Pin, Pout))
+        Q = system.flows(G, P)
+
+        self._n_solves += 1
+        if self.check_every and self._n_solves % self.check_every == 0:
+            self.max_error = max(self.max_error, self.verify(G, Pin, Pout, P))
+
+        # Compute shear stress if H is provided
+        if H is not None:
+            tau = H * Q
+            return P, Q, tau
+        else:
+            return P, Q
+
+    def verify(self, G, Pin, Pout, P):
+        """Relative pressure error of P against a full solve_for_flow."""
+        P_full, _ = solve_for_flow(G.copy(), Pin, Pout, system=self.system)
+        return np.max(np.abs(P - P_full)) / np.max(np.abs(P_full))
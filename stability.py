@@ -0,0 +1,281 @@
+import os
+import re
+import json
+import zipfile
+from statistics import NormalDist
+import numpy as np
+from network import branch_daughters, network_from_dict
+
+# Bifurcation statistics of a set of runs, computed in one pass over the result
+# files. Only a few numbers per seed and running sums per timestep are kept, so
+# memory does not grow with the number of timesteps or segments stored.
+#   branch loss   a daughter branch is empty at some timestep
+#   time to loss  first timestep a daughter branch is empty
+#   final Ncell   cells in each daughter branch at the last timestep
+#   P1            mean trajectory over the seeds of the probability of choosing the first daughter
+
+RESULT_NAME = re.compile(r"time_series_results(?:_BR(?P<rule>[^_]+))?_a_(?P<alpha>[-+0-9.eE]+?)"
+                         r"(?:\.json|\.jsonl|\.npz)?$")
+
+
+class StabilityStats:
+    """Streaming accumulator of the bifurcation statistics of one (branch_rule, alpha).
+
+    Feed it store_output records one at a time with add_record (in any
+    order), single states with add_step or dense result arrays with
+    add_arrays, then call summary. The branches are the daughters of the
+    first bifurcation of network (the default network if None) unless given.
+    """
+
+    def __init__(self, branches=None, network=None):
+        self.branches = branch_daughters(network) if branches is None else list(branches)
+        self._seeds = {}  # seed -> [first loss step (-1 if none), last step, final Ncell of each branch]
+        self._P1_sum = np.zeros(0)  # Running sums of P1 per timestep over the seeds
+        self._P1_sumsq = np.zeros(0)
+        self._P1_count = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._seeds)
+
+    def _add_P1(self, t, P1):
+        """Add P1 values at timesteps t (nan values are skipped)."""
+        t, P1 = np.atleast_1d(t), np.atleast_1d(P1)
+        if len(t) and t.max() >= len(self._P1_sum):
+            grow = t.max() + 1 - len(self._P1_sum)
+            self._P1_sum = np.concatenate([self._P1_sum, np.zeros(grow)])
+            self._P1_sumsq = np.concatenate([self._P1_sumsq, np.zeros(grow)])
+            self._P1_count = np.concatenate([self._P1_count, np.zeros(grow, dtype=np.int64)])
+        valid = ~np.isnan(P1)
+        np.add.at(self._P1_sum, t[valid], P1[valid])
+        np.add.at(self._P1_sumsq, t[valid], P1[valid] ** 2)
+        np.add.at(self._P1_count, t[valid], 1)
+
+    def add_record(self, record):
+        """Add one store_output record (with "Segments", Ncell only holds those segments)."""
+        index = record["Segments"].index if "Segments" in record else int
+        self.add_step(record["Random Seed"], record["Time Step"],
+                      [record["Ncell"][index(b)] for b in self.branches], record["P1"])
+
+    def add_step(self, seed, t, Ncell, P1):
+        """Add the state of one run at timestep t: Ncell of each branch and P1."""
+        seed, t, Ncell = int(seed), int(t), [int(n) for n in Ncell]
+        state = self._seeds.setdefault(seed, [-1, -1] + Ncell)
+        if min(Ncell) == 0 and (state[0] < 0 or t < state[0]):
+            state[0] = t
+        if t >= state[1]:
+            state[1:] = [t] + Ncell
+        self._add_P1(t, P1)
+
+    def add_arrays(self, seed, Ncell, P1):
+        """Add the runs of a block of seeds: Ncell (Nseed, Nt+1, Nseg) or only the branches (Nseed, Nt+1, 2), P1 (Nseed, Nt+1)."""
+        Ncell = np.asarray(Ncell)
+        if Ncell.shape[2] != len(self.branches):
+            Ncell = Ncell[:, :, self.branches]
+        empty = Ncell.min(axis=2) == 0
+        first_loss = np.where(empty.any(axis=1), empty.argmax(axis=1), -1)
+        last = Ncell.shape[1] - 1
+        for s, loss, final in zip(seed, first_loss, Ncell[:, -1]):
+            self._seeds[int(s)] = [int(loss), last] + final.tolist()
+        P1 = np.asarray(P1, dtype=float)
+        self._add_P1(np.tile(np.arange(P1.shape[1]), len(P1)), P1.ravel())
+
+    def per_seed(self):
+        """Arrays of the seeds, their first loss step (-1 if none) and final Ncell of each branch."""
+        seeds = sorted(self._seeds)
+        state = np.array([self._seeds[s] for s in seeds], dtype=np.int64).reshape(-1, 2 + len(self.branches))
+        return dict(seed=np.array(seeds, dtype=np.int64), loss_step=state[:, 0], final_ncell=state[:, 2:])
+
+    def summary(self, n_boot=1000, confidence=0.95, seed=0):
+        """Statistics with percentile bootstrap confidence intervals (normal intervals for the P1 trajectory)."""
+        runs = self.per_seed()
+        lost = runs["loss_step"] >= 0
+        loss_time = runs["loss_step"][lost].astype(float)
+        rng = np.random.default_rng(seed)
+        P1_mean, P1_ci = self.P1_trajectory(confidence)
+        final = runs["final_ncell"]
+        return {
+            "n_seeds": len(lost),
+            "loss_fraction": float(lost.mean()) if len(lost) else float('nan'),
+            "loss_fraction_ci": bootstrap_ci(lost.astype(float), np.mean, n_boot, confidence, rng),
+            "time_to_loss_mean": float(loss_time.mean()) if len(loss_time) else float('nan'),
+            "time_to_loss_median": float(np.median(loss_time)) if len(loss_time) else float('nan'),
+            "time_to_loss_ci": bootstrap_ci(loss_time, np.mean, n_boot, confidence, rng),
+            "final_ncell_mean": final.mean(axis=0).tolist() if len(final) else [],
+            "final_ncell_ci": [bootstrap_ci(final[:, b].astype(float), np.mean, n_boot, confidence, rng)
+                               for b in range(final.shape[1])],
+            "final_ncell_hist": [np.bincount(final[:, b]).tolist() for b in range(final.shape[1])],
+            "P1_mean": P1_mean.tolist(),
+            "P1_ci": P1_ci.tolist(),
+        }
+
+    def P1_trajectory(self, confidence=0.95):
+        """Mean P1 per timestep over the seeds and its (2, Nt+1) normal confidence interval."""
+        n = self._P1_count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._P1_sum / n
+            var = np.maximum(self._P1_sumsq / n - mean ** 2, 0) * n / (n - 1)
+            half = NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(var / n)
+        return mean, np.array([mean - half, mean + half])
+
+
+def wilson_interval(k, n, confidence=0.95):
+    """Wilson score interval [low, high] of a proportion of k successes in n trials."""
+    if n == 0:
+        return [0.0, 1.0]
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = k / n
+    centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return [float(max(centre - half, 0.0)), float(min(centre + half, 1.0))]
+
+
+def bootstrap_ci(values, statistic=np.mean, n_boot=1000, confidence=0.95, rng=None, block=256):
+    """Percentile bootstrap confidence interval [low, high] of statistic(values); nan for no values."""
+    values = np.asarray(values)
+    if len(values) == 0:
+        return [float('nan'), float('nan')]
+    rng = np.random.default_rng(rng)
+    boot = np.empty(n_boot)
+    for i in range(0, n_boot, block):  # Resample in blocks to bound memory
+        n = min(block, n_boot - i)
+        boot[i:i + n] = statistic(values[rng.integers(0, len(values), (n, len(values)))], axis=1)
+    low, high = np.quantile(boot, [0.5 - confidence / 2, 0.5 + confidence / 2])
+    return [float(low), float(high)]
+
+
+### Streaming readers
+
+def iter_records(path):
+    """store_output records of a JSON-lines file or a JSON list file, one at a time."""
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        # Decode the objects of the top-level list as the text arrives
+        decoder = json.JSONDecoder()
+        buffer, pos = f.read(1 << 16).lstrip().lstrip("["), 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:  # Object continues in the next block
+                more = f.read(1 << 16)
+                if not more:
+                    if buffer[pos:].strip():
+                        raise
+                    return
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield record
+
+
+def _npz_rows(archive, name, rows):
+    """Read a member of an .npz archive in blocks of rows along its first axis."""
+    with archive.open(name + ".npy") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        row = int(np.prod(shape[1:])) * dtype.itemsize
+        for start in range(0, shape[0], rows):
+            n = min(rows, shape[0] - start)
+            yield np.frombuffer(f.read(n * row), dtype=dtype).reshape((n,) + tuple(shape[1:]))
+
+
+def iter_arrays(path, rows=64, branches=None):
+    """(seed, Ncell of the branches, P1) of a binary result file in blocks of seeds.
+
+    The branches default to those of the network the file was run on. Ncell
+    of an .npz file holds every segment.
+    """
+    if path.endswith(".npz"):
+        with zipfile.ZipFile(path) as archive:
+            yield from zip(_npz_rows(archive, "seed", rows), _npz_rows(archive, "Ncell", rows),
+                           _npz_rows(archive, "P1", rows))
+        return
+    from results_io import load_results
+    results = load_results(path)
+    branches = result_branches(path) if branches is None else branches
+    for start in range(0, len(results["seed"]), rows):
+        block = slice(start, start + rows)
+        yield results["seed"][block], results["Ncell"][block][:, :, list(branches)], results["P1"][block]
+
+
+def analyze_file(path, branches=None, stats=None, rows=64):
+    """Stream one result file (JSON, JSON lines, .npy directory or .npz) into a StabilityStats.
+
+    The branches default to those of the network the file was run on (see
+    result_branches).
+    """
+    if stats is None:
+        stats = StabilityStats(result_branches(path) if branches is None else branches)
+    if path.endswith((".json", ".jsonl")):
+        for record in iter_records(path):
+            stats.add_record(record)
+    else:
+        for seed, Ncell, P1 in iter_arrays(path, rows, stats.branches):
+            stats.add_arrays(seed, Ncell, P1)
+    return stats
+
+
+def result_parameters(path):
+    """(branch_rule, alpha) of a result file, from its metadata or else its name (rule None if not named)."""
+    if not path.endswith((".json", ".jsonl")):
+        metadata = _metadata(path)
+        if "branch_alpha" in metadata:
+            return metadata.get("branch_rule"), float(metadata["branch_alpha"])
+    match = RESULT_NAME.search(os.path.basename(path.rstrip(os.sep)))
+    if match is None:
+        raise ValueError(f"Cannot tell the branch rule and alpha of {path}")
+    rule = match.group("rule")
+    return (int(rule) if rule and rule.isdigit() else rule), float(match.group("alpha"))
+
+
+def result_branches(path):
+    """Daughter branches of the first bifurcation of the network a result file was run on.
+
+    That network is stored in the metadata of the binary formats when it is
+    not the default one; JSON results carry no metadata and are taken to
+    come from the default network.
+    """
+    network = None
+    if not path.endswith((".json", ".jsonl")):
+        spec = _metadata(path).get("network")
+        network = None if spec is None else network_from_dict(spec)
+    return branch_daughters(network)
+
+
+def _metadata(path):
+    if os.path.isdir(path):
+        from results_io import load_results
+        return load_results(path)["metadata"]
+    with np.load(path) as archive:
+        return json.loads(str(archive["metadata"]))
+
+
+def analyze_sweep(paths, branches=None, n_boot=1000, confidence=0.95, seed=0):
+    """Summaries of a sweep's result files (or of every result file in a directory) by (branch_rule, alpha).
+
+    Files with the same parameters are pooled. The branches default to those
+    of each file's network (see result_branches). Returns a dict mapping
+    (branch_rule, alpha) to StabilityStats.summary, sorted by rule and alpha.
+    """
+    if isinstance(paths, str):
+        paths = [os.path.join(paths, name) for name in sorted(os.listdir(paths))
+                 if RESULT_NAME.search(name)]
+    stats = {}
+    for path in paths:
+        key = result_parameters(path)
+        stats[key] = analyze_file(path, branches, stats.get(key))
+    return {key: stats[key].summary(n_boot, confidence, seed)
+            for key in sorted(stats, key=lambda k: (str(k[0]), k[1]))}
+
+
+def summary_table(summaries):
+    """One row per (branch_rule, alpha) with the scalar statistics, e.g. for a stability curve over alpha."""
+    return [dict(branch_rule=rule, alpha=alpha, **{k: v for k, v in summary.items() if not k.startswith("P1")})
+            for (rule, alpha), summary in summaries.items()]
@@ -0,0 +1,405 @@
+import os
+import json
+import time
+import shutil
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Thread pools that numpy/scipy may start; workers are pinned to one thread each
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                    "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def make_jobs(alphas, seeds, branch_rules):
+    """Expand a parameter grid into (branch_rule, alpha, seed) jobs."""
+    return [(rule, float(alpha), int(seed)) for rule in branch_rules for alpha in alphas for seed in seeds]
+
+
+def chunk_jobs(jobs, chunk_size):
+    """Group jobs by (branch_rule, alpha) and split each group into chunks of up to chunk_size seeds."""
+    groups = {}
+    for rule, alpha, seed in jobs:
+        groups.setdefault((rule, alpha), []).append(seed)
+    return [(rule, alpha, seeds[i:i + chunk_size])
+            for (rule, alpha), seeds in groups.items() for i in range(0, len(seeds), chunk_size)]
+
+
+OUTPUT_FORMATS = ("jsonl", "npy", "npz")
+
+
+def output_path(output_dir, branch_rule, alpha, output_format="jsonl"):
+    """Result file of one (branch_rule, alpha); a directory of arrays for the npy format."""
+    # Two decimals as before, unless alpha needs more (e.g. from an adaptive sweep)
+    alpha = f"{alpha:.2f}" if abs(alpha - round(alpha, 2)) < 1e-9 else f"{alpha:.6g}"
+    name = f"time_series_results_BR{branch_rule}_a_{alpha}"
+    return os.path.join(output_dir, name if output_format == "npy" else f"{name}.{output_format}")
+
+
+def _init_worker():
+    """Pin the worker to a single BLAS thread."""
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = "1"
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def run_chunk(chunk, params, packed=False, checkpoint=None, checkpoint_every=0):
+    """Run one chunk of seeds sharing (branch_rule, alpha) in lockstep.
+
+    With packed=True the results come back as a dict of dense arrays (see
+    results_io.pack_results), which are much cheaper to send between processes.
+    checkpoint and checkpoint_every are passed on to run_ensemble. With a
+    result_cache.ResultCache as params['cache'], seeds found in the cache
+    are not run again and the others are added to it. A
+    profiling.StageProfiler as params['profiler'] times the chunk and
+    flushes its trace afterwards.
+    """
+    from ensemble import run_ensemble
+    rule, alpha, seeds = chunk
+    p = params
+    args = (p['Nt'], p['Pin'], p['Pout'], p['mu'], p['Nseg'], p['num_cell'], p['cell_size'], rule, alpha,
+            p['w1'], p['w2'], p['w3'], p['w4'], p['L'])
+    options = dict(monitor=p.get('monitor'), network=p.get('network'), legacy_rng=p.get('legacy_rng', False))
+    cache, profiler = p.get('cache'), p.get('profiler')
+    if cache is None:
+        results = run_ensemble(seeds, *args, **options, checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                               profiler=profiler)
+    else:
+        keys = [cache.key(seed, *args, **options) for seed in seeds]
+        results = [cache.get(key) for key in keys]
+        missing = [i for i, ts in enumerate(results) if ts is None]
+        if missing:
+            computed = run_ensemble([seeds[i] for i in missing], *args, **options, checkpoint=checkpoint,
+                                    checkpoint_every=checkpoint_every, profiler=profiler)
+            for i, ts in zip(missing, computed):
+                cache.put(keys[i], ts)
+                results[i] = ts
+    if profiler is not None:
+        profiler.flush()
+    if packed:
+        from results_io import pack_results
+        results = pack_results(results)
+    return chunk, results
+
+
+class Progress:
+    """Throughput and ETA reporting for completed runs."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def update(self, n):
+        self.done += n
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        print(f"{self.done}/{self.total} runs ({100 * self.done / self.total:.1f}%), "
+              f"{rate:.1f} runs/s, ETA {eta:.0f} s", flush=True)
+
+
+def write_chunk(output_dir, chunk, results, writers=None):
+    """Write the time series of a finished chunk to its (branch_rule, alpha) output.
+
+    JSON-lines files are appended to; for the binary formats the packed
+    arrays go into the matching ResultWriter of writers.
+    """
+    rule, alpha, seeds = chunk
+    if writers is not None:
+        writers[rule, alpha].write(results)
+        writers[rule, alpha].flush()
+        return
+    with open(output_path(output_dir, rule, alpha), "a") as f:
+        for seed_results in results:
+            for result in seed_results:
+                f.write(json.dumps(result, separators=(',', ':')) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _open_writers(output_dir, chunks, params, output_format, manifest=None):
+    """One preallocated ResultWriter per (branch_rule, alpha), or None for JSON lines.
+
+    When resuming (with the SweepManifest of the interrupted sweep) the
+    existing outputs are reopened instead, and JSON-lines files are cut
+    back to the end of their last completed chunk.
+    """
+    groups = {}
+    for rule, alpha, seeds in chunks:
+        groups.setdefault((rule, alpha), []).extend(seeds)
+    if output_format == "jsonl":
+        sizes = dict.fromkeys(groups, 0)
+        if manifest is not None:
+            for i, entry in manifest.done.items():
+                rule, alpha, _ = chunks[i]
+                sizes[rule, alpha] = max(sizes[rule, alpha], entry["size"])
+        for (rule, alpha), size in sizes.items():
+            with open(output_path(output_dir, rule, alpha), "a") as f:
+                f.truncate(size)
+        return None
+
+    from results_io import ResultWriter
+    metadata = {k: (v.tolist() if hasattr(v, 'tolist') else v) for k, v in params.items()
+                if k not in ('monitor', 'network', 'cache', 'profiler')}
+    if params.get('network') is not None:
+        metadata['network'] = params['network'].to_dict()
+    network = params.get('network')
+    Nj = len(network.bifurcations) if network is not None else 1
+    monitor = params.get('monitor')
+    if monitor is not None:
+        metadata['monitor'] = monitor.to_dict()
+    if manifest is not None:
+        # Outputs already compressed by the interrupted sweep are complete
+        groups = {key: seeds for key, seeds in groups.items()
+                  if os.path.isdir(output_path(output_dir, *key, "npy"))}
+    return {(rule, alpha): ResultWriter(output_path(output_dir, rule, alpha, "npy"), seeds, params['Nt'],
+                                        params['Nseg'], dict(metadata, branch_rule=rule, branch_alpha=alpha),
+                                        stop=monitor is not None, Nj=Nj, resume=manifest is not None)
+            for (rule, alpha), seeds in groups.items()}
+
+
+def _close_writers(output_dir, writers, output_format):
+    """Flush the result arrays and compress them for the npz format."""
+    from results_io import compress_results
+    for (rule, alpha), writer in writers.items():
+        writer.close()
+        if output_format == "npz":
+            compress_results(writer.path, output_path(output_dir, rule, alpha, "npz"))
+
+
+def iter_chunks(chunks, params, n_workers=None, packed=False, checkpoint=None, checkpoint_every=0):
+    """Run indexed chunks, a list of (index, chunk), on worker processes and yield (index, chunk, results) as they finish.
+
+    checkpoint maps a chunk index to the path of its run checkpoint (none if
+    None). At most two chunks per worker are in flight.
+    """
+    n_workers = n_workers or os.cpu_count()
+    chunks = dict(chunks)
+    checkpoint = checkpoint or (lambda i: None)
+
+    # Spawned workers inherit the single-thread BLAS settings before importing numpy
+    saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: "1" for var in BLAS_THREAD_VARS})
+    try:
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker) as pool:
+            submit = lambda i: pool.submit(run_chunk, chunks[i], params, packed, checkpoint(i), checkpoint_every)
+            queue = iter(chunks)
+            pending = {submit(i): i for i in itertools.islice(queue, 2 * n_workers)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    chunk, results = future.result()
+                    yield i, chunk, results
+                    next_i = next(queue, None)
+                    if next_i is not None:
+                        pending[submit(next_i)] = next_i
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def checkpoint_dir(output_dir):
+    """Directory holding the sweep specification, completed-chunk manifest and run checkpoints."""
+    return os.path.join(output_dir, "checkpoints")
+
+
+### Spread (alpha, seed, branch_rule) jobs over worker processes, streaming results to disk
+def run_sweep(alphas, seeds, branch_rules, params, output_dir, n_workers=None, chunk_size=50, progress=True,
+              output_format="jsonl", checkpoint_every=0, resume=False):
+    """Run a parameter sweep and write one result file per (branch_rule, alpha).
+
+    params holds the remaining run_simulation arguments (Nt, Pin, Pout, mu,
+    Nseg, num_cell, cell_size, w1, w2, w3, w4, L), optionally with a
+    ConvergenceMonitor as 'monitor' to stop resolved runs early, a
+    network.Network as 'network', 'legacy_rng': True to reproduce
+    results from before the per-run random streams and a
+    result_cache.ResultCache as 'cache' to reuse earlier runs and a
+    profiling.StageProfiler with a trace_dir as 'profiler' to trace the
+    stages of every chunk (pooled with profiling.aggregate_traces). Each
+    finished chunk is written as soon as it arrives and at most two chunks
+    per worker are in flight, so memory stays bounded however large the
+    sweep is.
+
+    output_format is "jsonl" (one store_output record per line), "npy" (a
+    memory-mappable directory of dense arrays, see results_io) or "npz"
+    (the same arrays compressed into one archive once the sweep is done).
+
+    Every chunk written to the outputs is recorded in the checkpoints
+    directory of output_dir, and with checkpoint_every > 0 each running
+    chunk also saves its state every checkpoint_every steps. An
+    interrupted sweep is continued with resume(output_dir) (or resume=True
+    here): finished chunks are skipped and partly run ones continue from
+    their last checkpoint, with the same results as an uninterrupted sweep.
+    The checkpoints directory is removed once the sweep has finished.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+    from checkpoint import SweepManifest, save_checkpoint, load_checkpoint
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = chunk_jobs(make_jobs(alphas, seeds, branch_rules), chunk_size)
+
+    checkpoints = checkpoint_dir(output_dir)
+    if resume and not os.path.exists(os.path.join(checkpoints, "sweep.pkl")):
+        raise FileNotFoundError(f"No interrupted sweep to resume in {output_dir}")
+    spec = dict(alphas=alphas, seeds=seeds, branch_rules=branch_rules, params=params, chunk_size=chunk_size,
+                output_format=output_format, checkpoint_every=checkpoint_every)
+    if resume:
+        _check_resume(output_dir, load_checkpoint(os.path.join(checkpoints, "sweep.pkl")), spec)
+    else:
+        shutil.rmtree(checkpoints, ignore_errors=True)
+        os.makedirs(checkpoints)
+        save_checkpoint(os.path.join(checkpoints, "sweep.pkl"), spec)
+    manifest = SweepManifest(os.path.join(checkpoints, "completed.jsonl"))
+    writers = _open_writers(output_dir, chunks, params, output_format, manifest if resume else None)
+    packed = writers is not None
+    todo = [i for i in range(len(chunks)) if i not in manifest.done]
+    chunk_checkpoint = lambda i: os.path.join(checkpoints, f"chunk_{i}.pkl")
+
+    tracker = Progress(sum(len(chunks[i][2]) for i in todo))
+    for i, chunk, results in iter_chunks([(i, chunks[i]) for i in todo], params, n_workers, packed,
+                                         chunk_checkpoint, checkpoint_every):
+        write_chunk(output_dir, chunk, results, writers)
+        size = None if writers is not None else os.path.getsize(output_path(output_dir, *chunk[:2]))
+        manifest.record(i, size)
+        if progress:
+            tracker.update(len(chunk[2]))
+    if writers is not None:
+        _close_writers(output_dir, writers, output_format)
+    shutil.rmtree(checkpoints)
+
+
+def _check_resume(output_dir, saved, spec):
+    """Raise if a sweep resumed in output_dir differs from the interrupted one in anything affecting its results."""
+    from result_cache import _canonical
+    ignore = ('cache', 'profiler')  # Do not change the results
+    differs = [name for name in ("alphas", "seeds", "branch_rules", "params", "chunk_size", "output_format")
+               if (_canonical({k: v for k, v in saved[name].items() if k not in ignore}) !=
+                   _canonical({k: v for k, v in spec[name].items() if k not in ignore})
+                   if name == "params" else _canonical(saved[name]) != _canonical(spec[name]))]
+    if differs:
+        raise ValueError(f"The interrupted sweep in {output_dir} was started with other {', '.join(differs)}; "
+                         f"resume it unchanged or start it afresh")
+
+
+def resume(output_dir, n_workers=None, progress=True):
+    """Continue an interrupted run_sweep from the checkpoints in output_dir."""
+    from checkpoint import load_checkpoint
+    spec = load_checkpoint(os.path.join(checkpoint_dir(output_dir), "sweep.pkl"))
+    if spec is None:
+        raise FileNotFoundError(f"No interrupted sweep to resume in {output_dir}")
+    run_sweep(spec.pop("alphas"), spec.pop("seeds"), spec.pop("branch_rules"), spec.pop("params"), output_dir,
+              n_workers, progress=progress, resume=True, **spec)
+
+
+### Adaptive alpha sampling around the stability transition
+def plan_refinement(counts, n_seeds, seed_step, target_width=0.1, alpha_tol=0.0125, min_jump=0.1,
+                    confidence=0.95):
+    """Runs to add next, as {alpha: number of new seeds}, from counts {alpha: (runs with branch loss, runs)}.
+
+    Neighbouring alphas whose branch-loss fractions differ by at least
+    min_jump may bracket the transition. Their estimates are made precise
+    first: each gets seed_step more seeds (up to n_seeds) while its
+    confidence interval is wider than target_width. Once both are precise
+    and their intervals do not overlap, the change is real and the
+    midpoint is added (with seed_step seeds) while they are more than
+    alpha_tol apart.
+    """
+    from stability import wilson_interval
+    alphas = sorted(counts)
+    fraction = {a: counts[a][0] / counts[a][1] for a in alphas}
+    interval = {a: wilson_interval(*counts[a], confidence) for a in alphas}
+    precise = {a: interval[a][1] - interval[a][0] <= target_width or counts[a][1] >= n_seeds for a in alphas}
+    plan = {}
+    for a, b in zip(alphas, alphas[1:]):
+        if abs(fraction[b] - fraction[a]) < min_jump:
+            continue
+        for x in (a, b):
+            if not precise[x]:
+                plan[x] = min(seed_step, n_seeds - counts[x][1])
+        separated = interval[a][1] < interval[b][0] or interval[b][1] < interval[a][0]
+        if precise[a] and precise[b] and separated and b - a > alpha_tol:
+            plan[(a + b) / 2] = min(seed_step, n_seeds)
+    return plan
+
+
+def transition_alpha(alphas, fraction, level=0.5):
+    """First alpha at which the branch-loss fraction crosses level, interpolated linearly (None if it does not)."""
+    for a, b, fa, fb in zip(alphas, alphas[1:], fraction, fraction[1:]):
+        if (fa - level) * (fb - level) <= 0 and fa != fb:
+            return a + (level - fa) * (b - a) / (fb - fa)
+    return None
+
+
+def run_adaptive_sweep(seeds, params, output_dir=None, branch_rule=5, alphas=(0.0, 0.25, 0.5, 0.75, 1.0),
+                       seed_step=20, target_width=0.2, alpha_tol=0.0125, min_jump=0.1, confidence=0.95,
+                       level=0.5, max_runs=None, n_workers=None, chunk_size=50, progress=True):
+    """Locate the alpha at which branch loss sets in with as few runs as possible.
+
+    Starts with the first seed_step seeds at every alpha of a coarse grid and
+    then, round by round, adds alphas and seeds where plan_refinement asks
+    for them, until it asks for nothing more or max_runs runs are done.
+    Every alpha uses a prefix of seeds, so neighbouring alphas compare the
+    same seeds. params is as for run_sweep; a ConvergenceMonitor there saves
+    most of the time of runs that lose a branch early.
+
+    With an output_dir the time series go to the usual JSON-lines file per
+    alpha and the final summary to adaptive_summary.json. Returns the
+    summary: per alpha the number of runs, branch-loss fraction and its
+    Wilson confidence interval, the interpolated transition alpha (where
+    the branch-loss fraction crosses level) and the total number of runs.
+    """
+    from stability import StabilityStats, wilson_interval
+    from results_io import unpack_results
+    from network import branch_daughters
+    if max_runs is not None and max_runs <= 0:
+        raise ValueError(f"max_runs must be positive, got {max_runs}")
+    branches = branch_daughters(params.get('network'))
+    seeds = [int(seed) for seed in seeds]
+    if not seeds:
+        raise ValueError("run_adaptive_sweep needs at least one seed")
+    stats, counts = {}, {}
+    plan = {float(alpha): min(seed_step, len(seeds)) for alpha in alphas}
+    runs = 0
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    while plan and (max_runs is None or runs < max_runs):
+        chunks = []
+        for alpha, n_new in sorted(plan.items()):
+            if alpha not in stats:
+                stats[alpha] = StabilityStats(branches)
+                if output_dir is not None:
+                    open(output_path(output_dir, branch_rule, alpha), "w").close()
+            new = seeds[len(stats[alpha]):len(stats[alpha]) + n_new]
+            chunks += [(branch_rule, alpha, new[i:i + chunk_size]) for i in range(0, len(new), chunk_size)]
+        for _, chunk, results in iter_chunks(list(enumerate(chunks)), params, n_workers, packed=True):
+            stats[chunk[1]].add_arrays(results["seed"], results["Ncell"], results["P1"])
+            if output_dir is not None:
+                write_chunk(output_dir, chunk, unpack_results(results))
+            runs += len(chunk[2])
+        counts = {alpha: (int((s.per_seed()["loss_step"] >= 0).sum()), len(s)) for alpha, s in stats.items()}
+        plan = plan_refinement(counts, len(seeds), seed_step, target_width, alpha_tol, min_jump, confidence)
+        if progress:
+            print(f"{runs} runs at {len(stats)} alphas, next: {len(plan)} alphas, "
+                  f"{sum(plan.values())} runs", flush=True)
+
+    alphas = sorted(counts)
+    fraction = [counts[a][0] / counts[a][1] for a in alphas]
+    summary = dict(branch_rule=branch_rule, runs=runs, transition_alpha=transition_alpha(alphas, fraction, level),
+                   alphas=[dict(alpha=a, n_seeds=counts[a][1], loss_fraction=f,
+                                loss_fraction_ci=wilson_interval(*counts[a], confidence))
+                           for a, f in zip(alphas, fraction)])
+    if output_dir is not None:
+        with open(os.path.join(output_dir, "adaptive_summary.json"), "w") as f:
+            json.dump(summary, f, indent=1)
+    return summary
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import math
+import time
+import heapq
+import numpy as np
+
+# Command-line entry point for sweeps described by a config file (JSON, or
+# TOML with Python 3.11+) instead of edited __main__ blocks:
+#
+#   {"output_dir": "Data", "output_format": "npz",
+#    "params": {"Nt": 20000, "Pin": 100, "Pout": 0, "mu": 3.5e-3, "num_cell": 8,
+#               "cell_size": 5e-6, "w2": 1, "w3": 0, "w4": 0, "L": 10e-6},
+#    "branch_rule": [5],
+#    "alpha": {"start": 0, "stop": 1, "step": 0.05},
+#    "seeds": {"list": "random_seed_list", "count": 100},
+#    "workers": 32, "chunk_size": 50, "checkpoint_every": 500,
+#    "early_stop": {"branch_loss": true}}
+#
+# params holds the run_simulation parameters; w1 defaults to 1 - w2 - w3 - w4,
+# L (segment length in m, one value or one per segment) to 10e-6 or the
+# lengths of the network, and Nseg is taken from the network. branch_rule and
+# alpha are a value, a list or a range {"start", "stop", "step" | "num"}
+# (stop included). The other keys are optional:
+#   seeds             a list, or one source: {"list": "random_seed_list"},
+#                     {"file": path} (JSON list or whitespace/comma separated),
+#                     {"range": [start, stop]} or {"random": n, "seed": s};
+#                     "start" and "count" select a slice of a list or file
+#   network           null for the default network, a network JSON file, or
+#                     {"ladder": n}, {"tree": generations}, {"lattice": [nx, ny]}
+#   output_format     "jsonl", "npy" or "npz" (see sweep.run_sweep)
+#   workers, chunk_size, checkpoint_every   as for sweep.run_sweep
+#   early_stop        true or the ConvergenceMonitor settings
+#   cache             a result_cache directory or {"directory", "max_bytes"}
+#   profile           a directory for profiling traces (see profiling.py)
+#   legacy_rng        true to reproduce results from before the per-run streams
+# Relative paths are taken from the directory of the config file.
+
+CONFIG_KEYS = ("output_dir", "output_format", "params", "branch_rule", "alpha", "seeds", "network", "workers",
+               "chunk_size", "checkpoint_every", "early_stop", "cache", "profile", "legacy_rng")
+PARAM_KEYS = ("Nt", "Pin", "Pout", "mu", "num_cell", "cell_size", "w1", "w2", "w3", "w4", "L")
+REQUIRED_PARAMS = ("Nt", "Pin", "Pout", "mu", "num_cell", "cell_size", "w2", "w3", "w4")
+
+
+def load_config(path):
+    """Read a config file (.toml or JSON)."""
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def grid_values(spec, name):
+    """Values of a grid axis: a value, a list or a range {"start", "stop", "step" | "num"} with stop included."""
+    if isinstance(spec, dict):
+        unknown = set(spec) - {"start", "stop", "step", "num"}
+        if unknown or "start" not in spec or "stop" not in spec or ("step" in spec) == ("num" in spec):
+            raise ValueError(f"{name} range needs start, stop and one of step or num, got {sorted(spec)}")
+        if "num" in spec:
+            return np.linspace(spec["start"], spec["stop"], spec["num"]).round(12).tolist()
+        n = int(math.floor((spec["stop"] - spec["start"]) / spec["step"] + 1e-9)) + 1
+        return (spec["start"] + spec["step"] * np.arange(n)).round(12).tolist()
+    return list(spec) if isinstance(spec, (list, tuple)) else [spec]
+
+
+def load_seeds(spec, base_dir="."):
+    """Seeds from a config seed source (see the header)."""
+    if isinstance(spec, (list, tuple)):
+        return [int(seed) for seed in spec]
+    spec = dict(spec)
+    start, count, seed = spec.pop("start", 0), spec.pop("count", None), spec.pop("seed", None)
+    if len(spec) != 1:
+        raise ValueError(f"seeds needs exactly one source (list, file, range or random), got {sorted(spec)}")
+    (source, value), = spec.items()
+    if source == "list":
+        import importlib
+        seeds = importlib.import_module(value).random_seeds
+    elif source == "file":
+        with open(os.path.join(base_dir, value)) as f:
+            text = f.read()
+        seeds = json.loads(text) if text.lstrip().startswith("[") else text.replace(",", " ").split()
+    elif source == "range":
+        seeds = range(*value)
+    elif source == "random":
+        seeds = np.random.default_rng(seed).integers(0, 1000000000, value)
+    else:
+        raise ValueError(f"Unknown seed source {source!r}")
+    seeds = [int(seed) for seed in seeds][start:]
+    return seeds if count is None else seeds[:count]
+
+
+def make_network(spec, base_dir="."):
+    """The network of a config (None for the default network)."""
+    from network import load_network, ladder_network, tree_network, lattice_network
+    if spec is None:
+        return None
+    if isinstance(spec, str):
+        return load_network(os.path.join(base_dir, spec))
+    generators = dict(ladder=ladder_network, tree=tree_network, lattice=lattice_network)
+    if len(spec) != 1 or next(iter(spec)) not in generators:
+        raise ValueError(f"network needs one of {sorted(generators)} or a file, got {sorted(spec)}")
+    (name, args), = spec.items()
+    return generators[name](*(args if isinstance(args, (list, tuple)) else [args]))
+
+
+def build_plan(config, base_dir="."):
+    """Check a config and expand it into a job plan: the run_sweep arguments plus the job and chunk counts."""
+    from sweep import OUTPUT_FORMATS, make_jobs, chunk_jobs
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown config keys {sorted(unknown)}, expected some of {CONFIG_KEYS}")
+    missing = [key for key in ("output_dir", "params", "alpha", "seeds") if key not in config]
+    if missing:
+        raise ValueError(f"Config is missing {missing}")
+    params = dict(config["params"])
+    unknown = set(params) - set(PARAM_KEYS)
+    missing = [key for key in REQUIRED_PARAMS if key not in params]
+    if unknown or missing:
+        raise ValueError(f"params: unknown {sorted(unknown)}, missing {missing}")
+    params.setdefault("w1", 1 - params["w2"] - params["w3"] - params["w4"])  # Persistence component
+
+    network = make_network(config.get("network"), base_dir)
+    Nseg = 40 if network is None else network.Nseg
+    if "L" in params:
+        params["L"] = np.broadcast_to(np.asarray(params["L"], dtype=float), (Nseg,)).copy()
+    else:
+        params["L"] = np.ones(Nseg) * 10e-6 if network is None else network.length.copy()
+    params["Nseg"] = Nseg
+    if network is not None:
+        params["network"] = network
+    if config.get("early_stop"):
+        from convergence import ConvergenceMonitor
+        early_stop = dict(config["early_stop"]) if isinstance(config["early_stop"], dict) else {}
+        if network is not None:
+            if not network.bifurcations:
+                raise ValueError("early_stop needs a network with a bifurcation to watch")
+            early_stop.setdefault("branches", network.bifurcations[0][2])
+        params["monitor"] = ConvergenceMonitor(**early_stop)
+    if config.get("cache"):
+        from result_cache import ResultCache
+        cache = config["cache"]
+        cache = dict(directory=cache) if isinstance(cache, str) else dict(cache)
+        params["cache"] = ResultCache(os.path.join(base_dir, cache.pop("directory")), **cache)
+    if config.get("profile"):
+        from profiling import StageProfiler
+        params["profiler"] = StageProfiler(os.path.join(base_dir, config["profile"]), per_step=False)
+    if config.get("legacy_rng"):
+        params["legacy_rng"] = True
+
+    output_format = config.get("output_format", "jsonl")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+    plan = dict(alphas=grid_values(config["alpha"], "alpha"),
+                branch_rules=grid_values(config.get("branch_rule", 5), "branch_rule"),
+                seeds=load_seeds(config["seeds"], base_dir), params=params,
+                output_dir=os.path.join(base_dir, config["output_dir"]), n_workers=config.get("workers"),
+                chunk_size=config.get("chunk_size", 50), output_format=output_format,
+                checkpoint_every=config.get("checkpoint_every", 0))
+    if len(set(plan["seeds"])) != len(plan["seeds"]):
+        raise ValueError("seeds has duplicates, which would run the same simulations twice")
+    plan["chunks"] = chunk_jobs(make_jobs(plan["alphas"], plan["seeds"], plan["branch_rules"]), plan["chunk_size"])
+    plan["runs"] = sum(len(chunk[2]) for chunk in plan["chunks"])
+    return plan
+
+
+def calibrate(plan, steps=20, replicas=None):
+    """Seconds per run per step and bytes per jsonl record, from a short run of the plan's first chunk."""
+    from ensemble import run_ensemble
+    rule, alpha, seeds = plan["chunks"][0]
+    seeds = seeds[:replicas or plan["chunk_size"]]
+    p = plan["params"]
+    args = (steps, p['Pin'], p['Pout'], p['mu'], p['Nseg'], p['num_cell'], p['cell_size'], rule, alpha,
+            p['w1'], p['w2'], p['w3'], p['w4'], p['L'])
+    run_ensemble(seeds[:1], 1, *args[1:], network=p.get('network'))  # Warm up
+    start = time.perf_counter()
+    results = run_ensemble(seeds, *args, network=p.get('network'), legacy_rng=p.get('legacy_rng', False))
+    step_time = (time.perf_counter() - start) / (len(seeds) * steps)
+    record_bytes = np.mean([len(json.dumps(record, separators=(',', ':'))) + 1 for record in results[0]])
+    return step_time, float(record_bytes)
+
+
+def estimate_cost(plan, step_time=None, record_bytes=None):
+    """Expected runs, simulated steps, CPU and wall time and output size of a plan (upper bounds with early stop).
+
+    Without step_time and record_bytes they are measured with calibrate.
+    Wall time assumes the chunks are handed to the workers in order as they
+    become free, as run_sweep does. Runs already in the cache are left out.
+    """
+    if step_time is None or record_bytes is None:
+        step_time, record_bytes = calibrate(plan)
+    p = plan["params"]
+    Nt, Nseg = p["Nt"], p["Nseg"]
+    cache = p.get("cache")
+    chunk_runs = [len(seeds) for _, _, seeds in plan["chunks"]]
+    if cache is not None:
+        options = dict(monitor=p.get('monitor'), network=p.get('network'), legacy_rng=p.get('legacy_rng', False))
+        chunk_runs = [sum(cache.key(seed, Nt, p['Pin'], p['Pout'], p['mu'], Nseg, p['num_cell'], p['cell_size'],
+                                    rule, alpha, p['w1'], p['w2'], p['w3'], p['w4'], p['L'], **options) not in cache
+                          for seed in seeds)
+                      for rule, alpha, seeds in plan["chunks"]]
+    runs = sum(chunk_runs)
+    n_workers = plan["n_workers"] or os.cpu_count()
+    workers = [0.0] * n_workers
+    for n in chunk_runs:
+        heapq.heapreplace(workers, workers[0] + n * Nt * step_time)
+    records = plan["runs"] * (Nt + 1)
+    if plan["output_format"] == "jsonl":
+        output_bytes = records * record_bytes
+    else:  # Ncell and D per segment and P1 per record; npz compresses this
+        output_bytes = records * (Nseg * 12 + 8)
+    return dict(runs=plan["runs"], cached_runs=plan["runs"] - runs, chunks=len(chunk_runs), workers=n_workers,
+                steps=runs * Nt, step_time=step_time, cpu_seconds=runs * Nt * step_time, wall_seconds=max(workers),
+                output_bytes=output_bytes, early_stop=p.get("monitor") is not None)
+
+
+def _duration(seconds):
+    return f"{seconds / 3600:.2f} h" if seconds >= 3600 else f"{seconds / 60:.1f} min" if seconds >= 60 \
+        else f"{seconds:.1f} s"
+
+
+def _size(n_bytes):
+    return f"{n_bytes / 1e9:.2f} GB" if n_bytes >= 1e9 else f"{n_bytes / 1e6:.1f} MB"
+
+
+def describe_plan(plan, cost=None):
+    """Human-readable summary of a plan and its estimated cost."""
+    alphas, rules = plan["alphas"], plan["branch_rules"]
+    p = plan["params"]
+    network = p.get("network")
+    lines = [f"output        {plan['output_dir']} ({plan['output_format']})",
+             f"branch rules  {rules}",
+             f"alphas        {len(alphas)}: {alphas[0]:g} ... {alphas[-1]:g}" if len(alphas) > 1 else
+             f"alphas        {alphas}",
+             f"seeds         {len(plan['seeds'])}: {plan['seeds'][:3]}{' ...' if len(plan['seeds']) > 3 else ''}",
+             f"network       {'default' if network is None else f'{network.Nseg} segments'}, Nt = {p['Nt']}",
+             f"jobs          {plan['runs']} runs in {len(plan['chunks'])} chunks of up to {plan['chunk_size']}",
+             f"early stop    {p['monitor'].to_dict() if 'monitor' in p else 'off'}"]
+    if cost is not None:
+        bound = " (at most, with early stop)" if cost["early_stop"] else ""
+        lines += [f"cached        {cost['cached_runs']} runs",
+                  f"step time     {cost['step_time'] * 1e6:.1f} us per run",
+                  f"cpu time      {_duration(cost['cpu_seconds'])}{bound}",
+                  f"wall time     {_duration(cost['wall_seconds'])} on {cost['workers']} workers{bound}",
+                  f"output        {_size(cost['output_bytes'])}" +
+                  (" before compression" if plan["output_format"] == "npz" else "")]
+    return "\n".join(lines)
+
+
+def run_plan(plan, resume=False, progress=True):
+    from sweep import run_sweep
+    run_sweep(plan["alphas"], plan["seeds"], plan["branch_rules"], plan["params"], plan["output_dir"],
+              plan["n_workers"], plan["chunk_size"], progress, plan["output_format"], plan["checkpoint_every"],
+              resume)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the parameter sweep described by a config file.")
+    parser.add_argument("config", help="JSON or TOML file describing the sweep")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="print the job plan and its estimated cost only (this times a short calibration "
+                             "run of the model: 20 steps of the first chunk's seeds)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted sweep of this config (which must be unchanged)")
+    parser.add_argument("--workers", type=int, help="override the number of worker processes")
+    parser.add_argument("--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if args.workers:
+        config["workers"] = args.workers
+    plan = build_plan(config, os.path.dirname(os.path.abspath(args.config)))
+    if args.dry_run:
+        print(describe_plan(plan, estimate_cost(plan)))
+        return 0
+    if not args.quiet:
+        print(describe_plan(plan), flush=True)
+    run_plan(plan, args.resume, not args.quiet)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())